@@ -0,0 +1,463 @@
+"""
+Нагрузочное тестирование Illustraitor AI без реальных вызовов DALL-E.
+
+Запускает локальную заглушку OpenAI API (images/models) с настраиваемой
+задержкой, долей ошибок и размером изображений, поднимает main.py с
+OPENAI_BASE_URL, указывающим на заглушку, и нагружает эндпоинты.
+Отчет - JSON (пропускная способность, p50/p95/p99, доля fallback),
+который удобно сравнивать между коммитами.
+
+Подкоманда validation - микробенчмарк разбора GenerateRequest в процессе,
+без сервера: корректные и некорректные тела запросов, сравнение со
+свободной моделью (строки без ограничений) и сборка промпта.
+
+Примеры:
+    python benchmark.py --requests 500 --concurrency 50
+    python benchmark.py --endpoints generate --latency 2 --rate-limit-ratio 0.1 --output bench.json
+    python benchmark.py validation --iterations 50000
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+ENDPOINTS = ("generate", "styles", "health", "test-openai")
+
+
+# ========== ЗАГЛУШКА OPENAI API ==========
+
+def build_fake_upstream(args):
+    """Приложение, отвечающее как images/models API OpenAI"""
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, Response
+
+    fake = FastAPI()
+    image_bytes = fake_png(args.payload_size)
+    port = args.port
+
+    def error(status: int, message: str, code: str) -> JSONResponse:
+        return JSONResponse(status_code=status, content={
+            "error": {"message": message, "type": "invalid_request_error", "code": code}
+        })
+
+    async def maybe_fail():
+        roll = random.random()
+        if roll < args.rate_limit_ratio:
+            return error(429, "Rate limit reached for images per minute", "rate_limit_exceeded")
+        roll -= args.rate_limit_ratio
+        if roll < args.auth_error_ratio:
+            return error(401, "Incorrect API key provided", "invalid_api_key")
+        roll -= args.auth_error_ratio
+        if roll < args.region_error_ratio:
+            return error(403, "Country, region, or territory not supported", "unsupported_country_region_territory")
+        roll -= args.region_error_ratio
+        if roll < args.timeout_ratio:
+            # Ответ дольше, чем клиент готов ждать: тип timeout должен определяться
+            # по APITimeoutError клиента, поэтому в тексте ответа слова timeout нет
+            await asyncio.sleep(args.timeout_delay)
+            return error(502, "Bad gateway", "server_error")
+        return None
+
+    @fake.post("/v1/images/generations")
+    async def images_generations(request: Request):
+        await asyncio.sleep(max(0.0, random.gauss(args.latency, args.latency_jitter)))
+        failure = await maybe_fail()
+        if failure is not None:
+            return failure
+        body = await request.json()
+        return {
+            "created": int(time.time()),
+            "data": [{
+                "url": f"http://127.0.0.1:{port}/files/{os.urandom(8).hex()}.png",
+                "revised_prompt": body.get("prompt", "")[:100]
+            }]
+        }
+
+    @fake.get("/v1/models/{model_id}")
+    async def retrieve_model(model_id: str):
+        await asyncio.sleep(args.models_latency)
+        failure = await maybe_fail()
+        if failure is not None:
+            return failure
+        return JSONResponse(
+            {"id": model_id, "object": "model", "created": 1698785189, "owned_by": "system"},
+            headers={"openai-organization": "org-benchmark"}
+        )
+
+    @fake.get("/files/{name}")
+    async def download(name: str):
+        return Response(image_bytes, media_type="image/png")
+
+    return fake
+
+
+def fake_png(size: int) -> bytes:
+    """PNG из случайного шума примерно заданного размера (шум почти не сжимается)"""
+    from PIL import Image
+
+    side = max(8, int((size / 3) ** 0.5))
+    image = Image.frombytes("RGB", (side, side), os.urandom(side * side * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def run_fake_upstream(args):
+    import uvicorn
+
+    uvicorn.run(build_fake_upstream(args), host="127.0.0.1", port=args.port, log_level="warning")
+
+
+# ========== ЗАПУСК ПРОЦЕССОВ ==========
+
+def start_process(command: list, env: dict) -> subprocess.Popen:
+    # Вывод дочерних процессов уходит в stderr, чтобы stdout содержал только отчет
+    return subprocess.Popen(command, cwd=ROOT, env={**os.environ, **env}, stdout=sys.stderr)
+
+
+async def wait_ready(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(url)).status_code < 500:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} не ответил за {timeout} с")
+
+
+def app_env(args, workdir: str) -> dict:
+    """Окружение main.py: заглушка вместо OpenAI, лимиты не мешают измерениям"""
+    env = {
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{args.upstream_port}/v1",
+        "OPENAI_IMAGES_PER_MINUTE": "1000000",
+        "OPENAI_IMAGES_BURST": "1000000",
+        "UPSTREAM_READ_TIMEOUT": str(args.app_timeout),
+        "OPENAI_RETRY_DEADLINE": str(args.app_timeout * 2),
+        "JOBS_DB_PATH": os.path.join(workdir, "jobs.db"),
+        "STATE_DB_PATH": os.path.join(workdir, "state.db"),
+        "IMAGE_STORE_DIR": os.path.join(workdir, "image_store"),
+    }
+    for item in args.app_env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    return env
+
+
+# ========== НАГРУЗКА И ОТЧЕТ ==========
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def build_request(endpoint: str, index: int, args) -> tuple:
+    api_key = f"sk-bench-{index % args.keys}"
+    if endpoint == "generate":
+        # Часть запросов повторяется, чтобы увидеть работу кэша и объединения
+        text_id = index % max(1, args.unique_texts) if args.unique_texts else index
+        return "POST", "/generate", {"json": {
+            "text": f"benchmark illustration {text_id}",
+            "style": args.style,
+            "api_key": None if args.demo else api_key
+        }}
+    if endpoint == "test-openai":
+        return "GET", "/test-openai", {"params": {"api_key": api_key}}
+    return "GET", f"/{endpoint}", {}
+
+
+async def drive(endpoint: str, base_url: str, args) -> dict:
+    """Нагрузка одного эндпоинта с фиксированной конкурентностью"""
+    latencies = []
+    statuses = {}
+    modes = {}
+    error_types = {}
+    counter = iter(range(args.requests))
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.client_timeout) as client:
+        async def worker():
+            for index in counter:
+                method, path, kwargs = build_request(endpoint, index, args)
+                started = time.perf_counter()
+                try:
+                    response = await client.request(method, path, **kwargs)
+                    status = str(response.status_code)
+                    if endpoint == "generate" and response.status_code == 200:
+                        body = response.json()
+                        modes[body.get("mode")] = modes.get(body.get("mode"), 0) + 1
+                        if body.get("error_type"):
+                            error_types[body["error_type"]] = error_types.get(body["error_type"], 0) + 1
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                latencies.append(time.perf_counter() - started)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    report = {
+        "requests": len(latencies),
+        "concurrency": args.concurrency,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99": round(percentile(latencies, 0.99) * 1000, 2),
+            "max": round(latencies[-1] * 1000, 2) if latencies else 0.0
+        },
+        "status_codes": statuses
+    }
+    if endpoint == "generate":
+        total = sum(modes.values())
+        report["modes"] = modes
+        report["error_types"] = error_types
+        report["fallback_rate"] = round(modes.get("fallback", 0) / total, 4) if total else 0.0
+    return report
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def run_benchmark(args) -> dict:
+    processes = []
+    with tempfile.TemporaryDirectory(prefix="illustraitor-bench-") as workdir:
+        try:
+            processes.append(start_process(
+                [sys.executable, __file__, "fake-upstream", "--port", str(args.upstream_port), *fake_upstream_argv(args)],
+                {}
+            ))
+            processes.append(start_process(
+                [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+                 "--port", str(args.app_port), "--workers", str(args.workers),
+                 "--log-level", "warning", "--no-access-log"],
+                app_env(args, workdir)
+            ))
+            base_url = f"http://127.0.0.1:{args.app_port}"
+            await wait_ready(f"http://127.0.0.1:{args.upstream_port}/v1/models/warmup")
+            await wait_ready(f"{base_url}/health")
+
+            results = {}
+            for endpoint in args.endpoints:
+                results[endpoint] = await drive(endpoint, base_url, args)
+            return {
+                "commit": git_commit(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "config": {
+                    "latency_s": args.latency,
+                    "payload_bytes": args.payload_size,
+                    "error_mix": {
+                        "rate_limit": args.rate_limit_ratio,
+                        "auth_error": args.auth_error_ratio,
+                        "region_restriction": args.region_error_ratio,
+                        "timeout": args.timeout_ratio
+                    },
+                    "keys": args.keys,
+                    "workers": args.workers,
+                    "demo": args.demo
+                },
+                "results": results
+            }
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait(timeout=10)
+
+
+# ========== МИКРОБЕНЧМАРК ВАЛИДАЦИИ ==========
+
+VALIDATION_CASES = {
+    "valid_demo": {"text": "A red fox, in the forest", "style": "fantasy"},
+    "valid_openai": {"text": "Рыжая лиса в осеннем лесу на рассвете " * 20, "style": "watercolor",
+                     "api_key": "sk-" + "x" * 48, "size": "1792x1024", "quality": "hd"},
+    "invalid_style": {"text": "red fox", "style": "nope"},
+    "invalid_size": {"text": "red fox", "size": "512x512"},
+    "empty_text": {"text": "   \n\t "},
+    "text_too_long": {"text": "x" * 5000},
+}
+
+
+def time_per_call(fn, iterations: int, repeats: int = 5) -> float:
+    """Лучшее из нескольких повторов среднее время вызова, микросекунды"""
+    best = float("inf")
+    for _ in range(repeats):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        best = min(best, (time.perf_counter() - started) / iterations)
+    return round(best * 1e6, 3)
+
+
+def run_validation_benchmark(args) -> dict:
+    # main.py импортируется без фоновых задач и файлов на диске
+    os.environ.setdefault("IMAGE_STORE_ENABLED", "0")
+    os.environ.setdefault("STATE_BACKEND", "memory")
+    os.environ.setdefault("OPENAI_WARMUP", "0")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, ROOT)
+    import main as app_module
+    from pydantic import BaseModel, ValidationError
+
+    class FreeFormRequest(BaseModel):
+        """Прежняя модель: произвольные строки без проверки значений"""
+        text: str
+        style: str = "fantasy"
+        api_key: str = None
+        size: str = "1024x1024"
+        quality: str = "standard"
+        no_cache: bool = False
+
+    def parse(model, body: bytes):
+        def call():
+            try:
+                model.model_validate_json(body)
+            except ValidationError:
+                pass
+        return call
+
+    results = {}
+    for name, payload in VALIDATION_CASES.items():
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        strict = time_per_call(parse(app_module.GenerateRequest, body), args.iterations)
+        free_form = time_per_call(parse(FreeFormRequest, body), args.iterations)
+        try:
+            app_module.GenerateRequest.model_validate_json(body)
+            status = 200
+        except ValidationError:
+            status = 422
+        results[name] = {
+            "status": status,
+            "strict_us": strict,
+            "free_form_us": free_form,
+            "overhead_us": round(strict - free_form, 3),
+            "strict_per_second": int(1e6 / strict) if strict else None
+        }
+
+    request = app_module.GenerateRequest(**VALIDATION_CASES["valid_openai"])
+    styles = app_module.STYLES
+    prefixes = app_module.STYLE_PROMPT_PREFIXES
+    results["prompt_build"] = {
+        "precomputed_prefix_us": time_per_call(lambda: prefixes[request.style] + request.text, args.iterations),
+        "f_string_us": time_per_call(
+            lambda: f"{styles[request.style]['prompt']}: {request.text}", args.iterations
+        )
+    }
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "config": {"iterations": args.iterations, "text_max_length": app_module.TEXT_MAX_LENGTH},
+        "results": results
+    }
+
+
+def fake_upstream_argv(args) -> list:
+    return [
+        "--latency", str(args.latency),
+        "--latency-jitter", str(args.latency_jitter),
+        "--models-latency", str(args.models_latency),
+        "--payload-size", str(args.payload_size),
+        "--rate-limit-ratio", str(args.rate_limit_ratio),
+        "--auth-error-ratio", str(args.auth_error_ratio),
+        "--region-error-ratio", str(args.region_error_ratio),
+        "--timeout-ratio", str(args.timeout_ratio),
+        "--timeout-delay", str(args.timeout_delay),
+    ]
+
+
+def add_upstream_arguments(parser: argparse.ArgumentParser):
+    group = parser.add_argument_group("заглушка OpenAI")
+    group.add_argument("--latency", type=float, default=1.0, help="средняя задержка генерации, с")
+    group.add_argument("--latency-jitter", type=float, default=0.2, help="стандартное отклонение задержки, с")
+    group.add_argument("--models-latency", type=float, default=0.05, help="задержка /models, с")
+    group.add_argument("--payload-size", type=int, default=1_000_000, help="размер PNG, байт")
+    group.add_argument("--rate-limit-ratio", type=float, default=0.0, help="доля ответов 429")
+    group.add_argument("--auth-error-ratio", type=float, default=0.0, help="доля ответов 401")
+    group.add_argument("--region-error-ratio", type=float, default=0.0, help="доля региональных ошибок 403")
+    group.add_argument("--timeout-ratio", type=float, default=0.0, help="доля зависающих ответов")
+    group.add_argument("--timeout-delay", type=float, default=30.0, help="задержка зависающего ответа, с")
+
+
+def parse_args(argv: list) -> argparse.Namespace:
+    if argv and argv[0] == "fake-upstream":
+        parser = argparse.ArgumentParser(prog="benchmark.py fake-upstream")
+        parser.add_argument("--port", type=int, default=9100)
+        add_upstream_arguments(parser)
+        args = parser.parse_args(argv[1:])
+        args.command = "fake-upstream"
+        return args
+    if argv and argv[0] == "validation":
+        parser = argparse.ArgumentParser(prog="benchmark.py validation")
+        parser.add_argument("--iterations", type=int, default=20000, help="вызовов на замер")
+        parser.add_argument("--output", help="файл для JSON отчета (по умолчанию stdout)")
+        args = parser.parse_args(argv[1:])
+        args.command = "validation"
+        return args
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS),
+                        help=f"эндпоинты через запятую: {', '.join(ENDPOINTS)}")
+    parser.add_argument("--requests", type=int, default=200, help="запросов на эндпоинт")
+    parser.add_argument("--concurrency", type=int, default=20, help="одновременных клиентов")
+    parser.add_argument("--keys", type=int, default=50, help="число разных API ключей")
+    parser.add_argument("--unique-texts", type=int, default=0,
+                        help="число разных текстов для /generate (0 - все разные)")
+    parser.add_argument("--style", default="fantasy")
+    parser.add_argument("--demo", action="store_true", help="генерация без API ключа (демо-режим)")
+    parser.add_argument("--client-timeout", type=float, default=120.0)
+    parser.add_argument("--app-port", type=int, default=9000)
+    parser.add_argument("--upstream-port", type=int, default=9100)
+    parser.add_argument("--workers", type=int, default=1, help="число процессов main.py")
+    parser.add_argument("--app-timeout", type=float, default=10.0, help="UPSTREAM_READ_TIMEOUT для main.py")
+    parser.add_argument("--app-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="дополнительные переменные окружения main.py")
+    parser.add_argument("--output", help="файл для JSON отчета (по умолчанию stdout)")
+    add_upstream_arguments(parser)
+    args = parser.parse_args(argv)
+    args.command = "run"
+    args.endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    unknown = set(args.endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"неизвестные эндпоинты: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv: list):
+    args = parse_args(argv)
+    if args.command == "fake-upstream":
+        run_fake_upstream(args)
+        return
+
+    if args.command == "validation":
+        report = run_validation_benchmark(args)
+    else:
+        report = asyncio.run(run_benchmark(args))
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,19 +1,148 @@
-from fastapi import FastAPI, HTTPException
+import time
+# Отсчет холодного старта: до импорта зависимостей
+IMPORT_STARTED = time.perf_counter()
+from fastapi import FastAPI, HTTPException, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, JSONResponse
-from pydantic import BaseModel
-from typing import Optional
-from openai import OpenAI
+from fastapi.responses import HTMLResponse, StreamingResponse, FileResponse, Response, PlainTextResponse
+from pydantic import BaseModel, Field, ValidationError, field_validator, model_validator
+from pydantic_core import PydanticCustomError
+from typing import Any, List, Literal, Optional
 import os
+import json
+import asyncio
+import random
+import bisect
+import heapq
+import hashlib
+import re
+import unicodedata
+import sqlite3
+import threading
 import logging
+import logging.handlers
+import queue
+import atexit
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
 from datetime import datetime
-import requests
+from email.utils import formatdate
+from urllib.parse import urlparse, parse_qs
+
+# SDK OpenAI (около 0.7 с импорта) и httpx загружаются при первом обращении к DALL-E:
+# демо-режим, /health и HEAD / отвечают, не дожидаясь их (см. load_openai)
+_openai = None
+
+# Вехи холодного старта: секунды от начала импорта main
+startup_milestones = {"imports": round(time.perf_counter() - IMPORT_STARTED, 4)}
+
+
+def mark_startup(milestone: str):
+    startup_milestones.setdefault(milestone, round(time.perf_counter() - IMPORT_STARTED, 4))
+
+
+def load_openai():
+    """Модуль openai; импортируется один раз при первом вызове"""
+    global _openai
+    if _openai is None:
+        started = time.perf_counter()
+        import openai
+        _openai = openai
+        startup_milestones["openai_import_s"] = round(time.perf_counter() - started, 4)
+        mark_startup("openai_loaded")
+    return _openai
 
 # Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# text - привычные строки, json - одна JSON запись на строку
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+# Доля успешных генераций, попадающих в лог (fallback и ошибки пишутся всегда)
+LOG_SUCCESS_SAMPLE_RATE = float(os.getenv("LOG_SUCCESS_SAMPLE_RATE", "1"))
+
+
+class LogEvent:
+    """Поля структурированной записи: в JSON превращаются только при выводе"""
+
+    __slots__ = ("fields",)
+
+    def __init__(self, fields: dict):
+        self.fields = fields
+
+    def __str__(self):
+        return json.dumps(self.fields, ensure_ascii=False, default=str)
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Запись лога целиком в JSON; поля LogEvent попадают на верхний уровень"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name
+        }
+        args = record.args if isinstance(record.args, tuple) else ()
+        if record.msg == "%s" and len(args) == 1 and isinstance(args[0], LogEvent):
+            data.update(args[0].fields)
+        else:
+            data["message"] = record.getMessage()
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Передает запись в очередь без форматирования: подстановка аргументов,
+    сериализация и запись в поток выполняются в потоке QueueListener,
+    а не в event loop. Очередь внутри процесса, поэтому копировать запись не нужно
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+_log_listeners = []
+
+
+def route_logger_through_queue(target: logging.Logger):
+    """Заменяет обработчики логгера очередью, сами обработчики работают в фоновом потоке"""
+    handlers = [h for h in target.handlers if not isinstance(h, logging.handlers.QueueHandler)]
+    if not handlers:
+        return
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    _log_listeners.append(listener)
+    target.handlers = [DeferredQueueHandler(log_queue)]
+
+
+def setup_logging():
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    # Как basicConfig: уже настроенное логирование (тесты, внешний конфиг) не трогаем
+    if root.handlers:
+        return
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    root.addHandler(handler)
+    route_logger_through_queue(root)
+    # httpx пишет строку на каждый вызов OpenAI - нужна только при отладке
+    if root.level > logging.DEBUG:
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+@atexit.register
+def stop_log_listeners():
+    # Остановка дожидается записи всех сообщений, оставшихся в очереди
+    while _log_listeners:
+        _log_listeners.pop().stop()
+
+
+setup_logging()
 logger = logging.getLogger(__name__)
 
 app = FastAPI(
@@ -32,43 +161,2190 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Модель запроса
-class GenerateRequest(BaseModel):
-    text: str
-    style: str = "fantasy"
-    api_key: Optional[str] = None
-    size: str = "1024x1024"
-    quality: str = "standard"
 
-# Стили (15 вариантов)
-STYLES = {
-    "business": {"name": "Бизнес", "prompt": "professional corporate style, clean lines, modern"},
-    "creative": {"name": "Креативный", "prompt": "artistic, imaginative, colorful, abstract"},
-    "minimalist": {"name": "Минимализм", "prompt": "minimalist design, simple lines, monochrome"},
-    "infographic": {"name": "Инфографика", "prompt": "infographic style, data visualization"},
-    "playful": {"name": "Игривый", "prompt": "fun, cartoonish, bright colors, friendly"},
-    "3d_render": {"name": "3D Рендер", "prompt": "3D render, Blender style, cinematic lighting"},
-    "watercolor": {"name": "Акварель", "prompt": "watercolor painting, soft edges, artistic"},
-    "cyberpunk": {"name": "Киберпанк", "prompt": "cyberpunk aesthetic, neon lights, futuristic"},
-    "flat_design": {"name": "Плоский дизайн", "prompt": "flat design, vector illustration"},
-    "oil_painting": {"name": "Масляная живопись", "prompt": "oil painting style, textured brush strokes"},
-    "pixel_art": {"name": "Пиксель-арт", "prompt": "pixel art, retro gaming style, 8-bit"},
-    "anime": {"name": "Аниме", "prompt": "anime style, Japanese animation, vibrant colors"},
-    "sketch": {"name": "Эскиз", "prompt": "sketch drawing, pencil lines, artistic"},
-    "vintage": {"name": "Винтаж", "prompt": "vintage style, retro aesthetic, nostalgic"},
-    "fantasy": {"name": "Фэнтези", "prompt": "fantasy art, magical creatures, mystical"}
-}
+@app.on_event("startup")
+async def route_server_logs():
+    """Логи uvicorn, включая access log, тоже пишутся из фонового потока"""
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        route_logger_through_queue(logging.getLogger(name))
+
+# Стили (15 вариантов)
+STYLES = {
+    "business": {"name": "Бизнес", "prompt": "professional corporate style, clean lines, modern"},
+    "creative": {"name": "Креативный", "prompt": "artistic, imaginative, colorful, abstract"},
+    "minimalist": {"name": "Минимализм", "prompt": "minimalist design, simple lines, monochrome"},
+    "infographic": {"name": "Инфографика", "prompt": "infographic style, data visualization"},
+    "playful": {"name": "Игривый", "prompt": "fun, cartoonish, bright colors, friendly"},
+    "3d_render": {"name": "3D Рендер", "prompt": "3D render, Blender style, cinematic lighting"},
+    "watercolor": {"name": "Акварель", "prompt": "watercolor painting, soft edges, artistic"},
+    "cyberpunk": {"name": "Киберпанк", "prompt": "cyberpunk aesthetic, neon lights, futuristic"},
+    "flat_design": {"name": "Плоский дизайн", "prompt": "flat design, vector illustration"},
+    "oil_painting": {"name": "Масляная живопись", "prompt": "oil painting style, textured brush strokes"},
+    "pixel_art": {"name": "Пиксель-арт", "prompt": "pixel art, retro gaming style, 8-bit"},
+    "anime": {"name": "Аниме", "prompt": "anime style, Japanese animation, vibrant colors"},
+    "sketch": {"name": "Эскиз", "prompt": "sketch drawing, pencil lines, artistic"},
+    "vintage": {"name": "Винтаж", "prompt": "vintage style, retro aesthetic, nostalgic"},
+    "fantasy": {"name": "Фэнтези", "prompt": "fantasy art, magical creatures, mystical"}
+}
+
+# Демо изображения для разных стилей
+DEMO_IMAGES = {
+    "business": "https://images.unsplash.com/photo-1497366754035-f200968a6e72",
+    "creative": "https://images.unsplash.com/photo-1542744095-fcf48d80b0fd",
+    "fantasy": "https://images.unsplash.com/photo-1519681393784-d120267933ba",
+    "minimalist": "https://images.unsplash.com/photo-1516035069371-29a1b244cc32",
+    "cyberpunk": "https://images.unsplash.com/photo-1518709268805-4e9042af2176",
+    "watercolor": "https://images.unsplash.com/photo-1579783902614-a3fb3927b6a5",
+    "default": "https://images.unsplash.com/photo-1519681393784-d120267933ba"
+}
+
+# Цвета градиента локальных демо-заглушек (от, до) для каждого стиля
+DEMO_PALETTES = {
+    "business": ((22, 46, 84), (98, 148, 196)),
+    "creative": ((236, 72, 153), (250, 204, 21)),
+    "minimalist": ((235, 235, 235), (120, 120, 120)),
+    "infographic": ((14, 116, 144), (163, 230, 53)),
+    "playful": ((251, 146, 60), (244, 114, 182)),
+    "3d_render": ((15, 23, 42), (129, 140, 248)),
+    "watercolor": ((147, 197, 253), (253, 186, 216)),
+    "cyberpunk": ((24, 8, 48), (236, 72, 153)),
+    "flat_design": ((59, 130, 246), (45, 212, 191)),
+    "oil_painting": ((120, 53, 15), (234, 179, 8)),
+    "pixel_art": ((30, 27, 75), (34, 197, 94)),
+    "anime": ((244, 63, 94), (96, 165, 250)),
+    "sketch": ((250, 250, 249), (87, 83, 78)),
+    "vintage": ((120, 84, 52), (231, 209, 168)),
+    "fantasy": ((49, 20, 94), (102, 126, 234)),
+    "default": ((102, 126, 234), (118, 75, 162))
+}
+
+# ========== МОДЕЛИ ЗАПРОСОВ ==========
+
+# Размеры и качество, которые поддерживает DALL-E 3
+IMAGE_SIZES = ("1024x1024", "1792x1024", "1024x1792")
+IMAGE_QUALITIES = ("standard", "hd")
+# Начало промпта для каждого стиля собирается один раз
+STYLE_PROMPT_PREFIXES = {name: f"{style['prompt']}: " for name, style in STYLES.items()}
+# Лимит промпта DALL-E 3: текст должен поместиться вместе с самым длинным префиксом
+DALLE_PROMPT_MAX_LENGTH = 4000
+DALLE_TEXT_MAX_LENGTH = DALLE_PROMPT_MAX_LENGTH - max(len(prefix) for prefix in STYLE_PROMPT_PREFIXES.values())
+TEXT_MAX_LENGTH = min(int(os.getenv("TEXT_MAX_LENGTH", str(DALLE_TEXT_MAX_LENGTH))), DALLE_TEXT_MAX_LENGTH)
+API_KEY_MAX_LENGTH = 256
+
+# Допустимые значения проверяются pydantic до вызова обработчика:
+# неверный запрос получает 422 без логов, клиентов OpenAI и сетевых вызовов
+StyleName = Literal[tuple(STYLES)]
+ImageSize = Literal[IMAGE_SIZES]
+ImageQuality = Literal[IMAGE_QUALITIES]
+
+# Управляющие символы, кроме пробельных (их схлопывает str.split)
+_CONTROL_CHARS = re.compile(r"[\x00-\x08\x0e-\x1b\x7f]")
+
+
+# Модель запроса
+class GenerateRequest(BaseModel):
+    text: str  # Длина проверяется после нормализации (normalize_text)
+    style: StyleName = "fantasy"
+    api_key: Optional[str] = Field(None, max_length=API_KEY_MAX_LENGTH)
+    size: ImageSize = "1024x1024"
+    quality: ImageQuality = "standard"
+    no_cache: bool = False  # Принудительная генерация в обход кэша
+    allow_similar: bool = True  # Разрешить готовое изображение для почти такого же текста
+
+    @field_validator("text")
+    @classmethod
+    def normalize_text(cls, value: str) -> str:
+        """Схлопывание пробелов и удаление управляющих символов; пустой или длинный текст - 422"""
+        value = unicodedata.normalize("NFC", value)
+        if not value.isprintable():
+            value = _CONTROL_CHARS.sub("", value)
+        value = " ".join(value.split())
+        if not value:
+            raise ValueError("Текст не может быть пустым")
+        if len(value) > TEXT_MAX_LENGTH:
+            # Та же ошибка, что у Field(max_length), но для текста, который уйдет в промпт
+            raise PydanticCustomError(
+                "string_too_long",
+                "String should have at most {max_length} characters",
+                {"max_length": TEXT_MAX_LENGTH}
+            )
+        return value
+
+    @field_validator("api_key")
+    @classmethod
+    def normalize_api_key(cls, value: Optional[str]) -> Optional[str]:
+        # Пустой ключ - демо-режим, как и отсутствующий
+        value = value.strip() if value is not None else None
+        return value or None
+
+    @model_validator(mode="wrap")
+    @classmethod
+    def measure_validation(cls, data, handler):
+        """Этап validation в метриках: проверка идет до обработчика, поэтому измеряется здесь"""
+        started = time.perf_counter()
+        try:
+            return handler(data)
+        finally:
+            GENERATE_STAGE_DURATION.observe(time.perf_counter() - started, "validation")
+
+# Пакетная генерация
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "50"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "16"))
+BATCH_FORMATS = {"ndjson": "application/x-ndjson", "sse": "text/event-stream"}
+
+class BatchGenerateRequest(BaseModel):
+    # Число элементов и формат проверяются при разборе запроса (422), а сами элементы -
+    # по отдельности в generate_batch: один неверный элемент не отклоняет весь пакет
+    items: List[Any] = Field(..., min_length=1, max_length=BATCH_MAX_ITEMS)
+    concurrency: Optional[int] = None  # По умолчанию BATCH_CONCURRENCY
+    format: Literal[tuple(BATCH_FORMATS)] = "ndjson"  # ndjson или sse
+
+
+def encode_batch_event(event: str, payload: dict, fmt: str) -> str:
+    """Одна запись потока пакетной генерации"""
+    data = json.dumps(payload, ensure_ascii=False)
+    if fmt == "sse":
+        return f"event: {event}\ndata: {data}\n\n"
+    return data + "\n"
+
+# ========== UPSTREAM: ОБЩИЙ ПУЛ СОЕДИНЕНИЙ OPENAI ==========
+
+# Настройки транспорта (читаются один раз при старте процесса)
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "60"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "10"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "120"))
+# HTTP/2 включается, только если установлен пакет h2
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "1") == "1"
+# Прокси из окружения по умолчанию игнорируются (раньше переменные удалялись
+# из os.environ на каждом запросе, что влияло на весь процесс)
+UPSTREAM_USE_PROXY = os.getenv("UPSTREAM_USE_PROXY", "0") == "1"
+
+# Адрес API OpenAI (для прокси-шлюзов и локального стенда benchmark.py)
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+
+# LRU кэш клиентов OpenAI по хэшу API ключа
+OPENAI_CLIENT_CACHE_SIZE = int(os.getenv("OPENAI_CLIENT_CACHE_SIZE", "256"))
+OPENAI_CLIENT_IDLE_TTL = float(os.getenv("OPENAI_CLIENT_IDLE_TTL", "900"))
+
+_upstream_http_client: Optional["httpx.AsyncClient"] = None
+
+
+def get_upstream_http_client() -> "httpx.AsyncClient":
+    """Общий для процесса HTTP клиент с keep-alive пулом соединений"""
+    global _upstream_http_client
+    if _upstream_http_client is None or _upstream_http_client.is_closed:
+        import httpx
+        http2 = UPSTREAM_HTTP2 and importlib.util.find_spec("h2") is not None
+        if UPSTREAM_HTTP2 and not http2:
+            logger.info("Пакет h2 не установлен, upstream использует HTTP/1.1")
+        _upstream_http_client = httpx.AsyncClient(
+            http2=http2,
+            trust_env=UPSTREAM_USE_PROXY,
+            limits=httpx.Limits(
+                max_connections=UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+                keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(UPSTREAM_READ_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT),
+        )
+    return _upstream_http_client
+
+
+def hash_api_key(api_key: str) -> str:
+    """Хэш API ключа: сам ключ не хранится в кэшах и не попадает в логи"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+class OpenAIClientCache:
+    """
+    Ограниченный LRU кэш легковесных клиентов OpenAI.
+    Все клиенты используют общий транспорт, поэтому повторные запросы
+    с тем же ключом идут по уже прогретым соединениям.
+    """
+
+    def __init__(self, max_size: int, idle_ttl: float):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self._clients: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, api_key: str) -> "openai.AsyncOpenAI":
+        key_hash = hash_api_key(api_key)
+        now = time.monotonic()
+        self._evict_idle(now)
+
+        entry = self._clients.pop(key_hash, None)
+        if entry is not None:
+            client = entry[0]
+        else:
+            # Повторы выполняет call_images_api (с учетом лимитов), а не SDK
+            client = load_openai().AsyncOpenAI(
+                api_key=api_key,
+                base_url=OPENAI_BASE_URL,
+                http_client=get_upstream_http_client(),
+                max_retries=0
+            )
+        self._clients[key_hash] = (client, now)
+
+        while len(self._clients) > self.max_size:
+            self._clients.popitem(last=False)
+        return client
+
+    def _evict_idle(self, now: float):
+        # Самые старые записи в начале, поэтому достаточно просмотреть префикс
+        while self._clients:
+            key_hash, (_, last_used) = next(iter(self._clients.items()))
+            if now - last_used < self.idle_ttl:
+                break
+            del self._clients[key_hash]
+
+    def clear(self):
+        # Клиенты не закрываются по отдельности: это закрыло бы общий транспорт
+        self._clients.clear()
+
+    def __len__(self):
+        return len(self._clients)
+
+
+openai_clients = OpenAIClientCache(OPENAI_CLIENT_CACHE_SIZE, OPENAI_CLIENT_IDLE_TTL)
+
+
+@app.on_event("shutdown")
+async def close_upstream():
+    """Закрытие общего пула соединений при остановке сервера"""
+    global _upstream_http_client
+    openai_clients.clear()
+    if _upstream_http_client is not None:
+        await _upstream_http_client.aclose()
+        _upstream_http_client = None
+
+# ========== ОБЩЕЕ СОСТОЯНИЕ МЕЖДУ ВОРКЕРАМИ ==========
+
+# sqlite - файл в режиме WAL, общий для всех процессов на хосте;
+# redis - внешний сервер (REDIS_URL); memory - только текущий процесс
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite").lower()
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "state.db")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Как часто удалять из SQLite истекшие записи (число записей между очистками)
+STATE_SQLITE_CLEANUP_EVERY = 500
+
+
+class MemoryStateBackend:
+    """Состояние в памяти процесса: подходит только для одного воркера"""
+
+    name = "memory"
+    # Все читатели записей работают на этом же хосте и видят его диск
+    same_host = True
+
+    def __init__(self):
+        self._data = {}
+
+    def _alive(self, key: str) -> Optional[tuple]:
+        entry = self._data.get(key)
+        if entry is not None and entry[0] <= time.time():
+            del self._data[key]
+            return None
+        return entry
+
+    async def get(self, key: str) -> Optional[dict]:
+        entry = self._alive(key)
+        return entry[1] if entry is not None else None
+
+    async def set(self, key: str, value: dict, ttl: float):
+        self._data[key] = (time.time() + ttl, value)
+
+    async def add(self, key: str, value: dict, ttl: float) -> bool:
+        """Запись только если ключа нет (захват блокировки)"""
+        if self._alive(key) is not None:
+            return False
+        self._data[key] = (time.time() + ttl, value)
+        return True
+
+    async def delete(self, key: str):
+        self._data.pop(key, None)
+
+    async def close(self):
+        self._data.clear()
+
+
+class SQLiteStateBackend:
+    """
+    Состояние в SQLite (WAL): все воркеры на одном хосте видят одни и те же
+    записи, а данные переживают перезапуск. Обращения выполняются в потоке.
+    """
+
+    name = "sqlite"
+    same_host = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._writes = 0
+        # timeout - ожидание блокировки записи, которую держит другой процесс
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " expires_at REAL NOT NULL)"
+            )
+
+    def _get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM state WHERE key = ? AND expires_at > ?",
+                (key, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set(self, key: str, value: dict, ttl: float, only_new: bool) -> bool:
+        now = time.time()
+        data = json.dumps(value, ensure_ascii=False)
+        with self._lock, self._conn:
+            # Удаление истекшей записи и вставка идут в одной транзакции,
+            # поэтому захват ключа атомарен и между процессами
+            self._conn.execute("DELETE FROM state WHERE key = ? AND expires_at <= ?", (key, now))
+            verb = "INSERT OR IGNORE" if only_new else "INSERT OR REPLACE"
+            inserted = self._conn.execute(
+                f"{verb} INTO state (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, data, now + ttl)
+            ).rowcount == 1
+            self._writes += 1
+            if self._writes % STATE_SQLITE_CLEANUP_EVERY == 0:
+                self._conn.execute("DELETE FROM state WHERE expires_at <= ?", (now,))
+        return inserted
+
+    def _delete(self, key: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM state WHERE key = ?", (key,))
+
+    async def get(self, key: str) -> Optional[dict]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: dict, ttl: float):
+        await asyncio.to_thread(self._set, key, value, ttl, False)
+
+    async def add(self, key: str, value: dict, ttl: float) -> bool:
+        return await asyncio.to_thread(self._set, key, value, ttl, True)
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self._delete, key)
+
+    async def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RedisStateBackend:
+    """
+    Состояние в Redis. Подходит любой асинхронный клиент с методами
+    get(key), set(key, value, ex=..., nx=...) и delete(key) - например,
+    redis.asyncio.Redis или совместимая заглушка.
+    """
+
+    name = "redis"
+    # Записи читают воркеры других хостов, у которых нет локальных файлов этого хоста
+    same_host = False
+
+    def __init__(self, client):
+        self.client = client
+
+    async def get(self, key: str) -> Optional[dict]:
+        data = await self.client.get(key)
+        return json.loads(data) if data is not None else None
+
+    async def set(self, key: str, value: dict, ttl: float):
+        await self.client.set(key, json.dumps(value, ensure_ascii=False), ex=max(1, int(ttl)))
+
+    async def add(self, key: str, value: dict, ttl: float) -> bool:
+        result = await self.client.set(
+            key, json.dumps(value, ensure_ascii=False), ex=max(1, int(ttl)), nx=True
+        )
+        return bool(result)
+
+    async def delete(self, key: str):
+        await self.client.delete(key)
+
+    async def close(self):
+        close = getattr(self.client, "aclose", None) or getattr(self.client, "close", None)
+        if close is not None:
+            result = close()
+            if asyncio.iscoroutine(result):
+                await result
+
+
+def create_state_backend(kind: str):
+    """Создание хранилища состояния по имени из STATE_BACKEND"""
+    if kind == "memory":
+        return MemoryStateBackend()
+    if kind == "redis":
+        if importlib.util.find_spec("redis") is not None:
+            import redis.asyncio
+            return RedisStateBackend(redis.asyncio.from_url(REDIS_URL))
+        logger.warning("Пакет redis не установлен, общее состояние хранится в SQLite")
+    elif kind != "sqlite":
+        logger.warning("Неизвестный STATE_BACKEND=%s, используется SQLite", kind)
+    return SQLiteStateBackend(STATE_DB_PATH)
+
+
+_state_backend = None
+
+
+def get_state_backend():
+    """Общее хранилище состояния (создается при старте; вне сервера - при первом обращении)"""
+    global _state_backend
+    if _state_backend is None:
+        _state_backend = create_state_backend(STATE_BACKEND)
+    return _state_backend
+
+
+@app.on_event("startup")
+async def open_state_backend():
+    # Подключение к SQLite и PRAGMA выполняются в потоке, как у JobStore
+    global _state_backend
+    if _state_backend is None:
+        _state_backend = await asyncio.to_thread(create_state_backend, STATE_BACKEND)
+
+
+@app.on_event("shutdown")
+async def close_state_backend():
+    global _state_backend
+    if _state_backend is not None:
+        await _state_backend.close()
+        _state_backend = None
+
+# ========== КЭШ ГЕНЕРАЦИЙ ==========
+
+GENERATION_CACHE_SIZE = int(os.getenv("GENERATION_CACHE_SIZE", "1024"))
+# Ссылки OpenAI живут около часа, поэтому TTL по умолчанию чуть меньше
+GENERATION_CACHE_TTL = float(os.getenv("GENERATION_CACHE_TTL", "3300"))
+# Запас до истечения подписанной ссылки, после которого запись считается устаревшей
+IMAGE_URL_EXPIRY_MARGIN = 120
+
+
+def generation_cache_key(prompt: str, size: str, quality: str) -> str:
+    """Ключ кэша: хэш итогового промпта и параметров изображения"""
+    payload = json.dumps(["dall-e-3", prompt, size, quality], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def image_url_expiry(image_url: str) -> Optional[float]:
+    """
+    Время истечения подписанной ссылки OpenAI (параметр se= в Azure SAS URL).
+    Возвращает unix timestamp или None, если параметр не найден.
+    """
+    try:
+        values = parse_qs(urlparse(image_url).query).get("se")
+        if not values:
+            return None
+        return datetime.fromisoformat(values[0].replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+
+class GenerationCache:
+    """
+    Двухуровневый кэш результатов генерации: LRU в памяти процесса
+    и общее хранилище состояния, которое видят все воркеры
+    (в SQLite записи к тому же переживают перезапуск).
+    """
+
+    def __init__(self, max_size: int, ttl: float, backend_factory=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend_factory = backend_factory
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def backend(self):
+        return self.backend_factory() if self.backend_factory is not None else None
+
+    def entry_ttl(self, value: dict, same_host: bool = True) -> float:
+        """
+        TTL записи с учетом срока жизни ссылки на изображение.
+        same_host=False - запись прочитают на других хостах, где локальной копии нет
+        и отдается исходная ссылка, поэтому ее срок учитывается всегда
+        """
+        ttl = self.ttl
+        if value.get("image_id") and same_host:
+            # Изображение уже в локальном хранилище, срок ссылки OpenAI не важен
+            return ttl
+        expires_at = image_url_expiry(value.get("image_url", ""))
+        if expires_at is not None:
+            ttl = min(ttl, expires_at - time.time() - IMAGE_URL_EXPIRY_MARGIN)
+        return ttl
+
+    def _image_lost(self, value: dict) -> bool:
+        """Локальная копия вытеснена из хранилища (или ее нет на этом хосте), а ссылка OpenAI истекла"""
+        image_id = value.get("image_id")
+        if not image_id or (image_store is not None and image_store.has(image_id)):
+            return False
+        return self.entry_ttl(value, same_host=False) <= 0
+
+    async def get(self, key: str) -> Optional[dict]:
+        entry = self._memory.get(key)
+        if entry is None:
+            entry = await self._read_shared(key)
+            if entry is not None:
+                self._remember(key, entry)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, value = entry
+        if expires_at <= time.time() or self._image_lost(value):
+            self.misses += 1
+            await self.delete(key)
+            return None
+        self.hits += 1
+        self._memory.move_to_end(key)
+        return value
+
+    async def peek_shared(self, key: str) -> Optional[dict]:
+        """Запись из общего хранилища без учета в статистике попаданий"""
+        entry = await self._read_shared(key)
+        if entry is None or entry[0] <= time.time():
+            return None
+        self._remember(key, entry)
+        return entry[1]
+
+    async def set(self, key: str, value: dict):
+        ttl = self.entry_ttl(value)
+        if ttl <= 0:
+            return
+        entry = (time.time() + ttl, value)
+        self._remember(key, entry)
+        backend = self.backend
+        if backend is not None:
+            shared_ttl = ttl if backend.same_host else self.entry_ttl(value, same_host=False)
+            if shared_ttl <= 0:
+                return
+            try:
+                await backend.set(
+                    f"gen:{key}", {"expires_at": time.time() + shared_ttl, "value": value}, shared_ttl
+                )
+            except Exception as e:
+                logger.warning("Не удалось записать кэш в общее хранилище: %s", e)
+
+    async def delete(self, key: str):
+        self._memory.pop(key, None)
+        backend = self.backend
+        if backend is not None:
+            try:
+                await backend.delete(f"gen:{key}")
+            except Exception as e:
+                logger.warning("Не удалось удалить запись из общего хранилища: %s", e)
+
+    def __len__(self):
+        return len(self._memory)
+
+    def _remember(self, key: str, entry: tuple):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    async def _read_shared(self, key: str) -> Optional[tuple]:
+        backend = self.backend
+        if backend is None:
+            return None
+        try:
+            data = await backend.get(f"gen:{key}")
+        except Exception as e:
+            # Недоступное общее хранилище не должно ломать генерацию
+            logger.warning("Не удалось прочитать кэш из общего хранилища: %s", e)
+            return None
+        if not data:
+            return None
+        return data["expires_at"], data["value"]
+
+
+generation_cache = GenerationCache(GENERATION_CACHE_SIZE, GENERATION_CACHE_TTL, get_state_backend)
+
+
+def cache_bypass_flags(request: GenerateRequest, cache_control: Optional[str]) -> tuple:
+    """
+    Разбор флагов обхода кэша: (не читать из кэша, не сохранять в кэш).
+    Cache-Control: no-cache - всегда новая генерация, результат сохраняется;
+    Cache-Control: no-store - кэш не используется совсем.
+    """
+    directives = {d.strip().lower() for d in (cache_control or "").split(",")}
+    no_store = "no-store" in directives
+    skip_lookup = request.no_cache or no_store or "no-cache" in directives
+    return skip_lookup, no_store
+
+# ========== ИНДЕКС ПОХОЖИХ ПРОМПТОВ ==========
+
+# Минимальное сходство текстов (коэффициент Жаккара по словам), при котором
+# вместо новой генерации отдается готовое изображение; 1 - только перестановки слов
+SIMILAR_PROMPT_THRESHOLD = float(os.getenv("SIMILAR_PROMPT_THRESHOLD", "0.9"))
+SIMILAR_INDEX_SIZE = int(os.getenv("SIMILAR_INDEX_SIZE", str(GENERATION_CACHE_SIZE)))
+# MinHash: SIMILAR_BANDS полос по SIMILAR_ROWS значений. Кандидаты находятся
+# при сходстве от ~(1/bands)^(1/rows) = 0.5, точный отбор - по Жаккару
+SIMILAR_BANDS = 16
+SIMILAR_ROWS = 4
+# Длинный текст представлен SIMILAR_MAX_TOKENS словами с наименьшим хэшем (bottom-k):
+# выборка не зависит от порядка слов, а подпись любого текста считается за ~2 мс
+SIMILAR_MAX_TOKENS = 64
+# Служебные слова, не влияющие на изображение
+PROMPT_STOPWORDS = frozenset({"a", "an", "the", "and", "of", "и", "а"})
+_MINHASH_PRIME = (1 << 61) - 1
+_minhash_random = random.Random(20240601)  # Фиксированные параметры: подписи стабильны между процессами
+_MINHASH_PARAMS = [
+    (_minhash_random.randrange(1, _MINHASH_PRIME), _minhash_random.randrange(0, _MINHASH_PRIME))
+    for _ in range(SIMILAR_BANDS * SIMILAR_ROWS)
+]
+
+
+def prompt_tokens(text: str) -> frozenset:
+    """Нормализация текста: регистр, пунктуация, пробелы и порядок слов не важны"""
+    text = unicodedata.normalize("NFKC", text).casefold().replace("ё", "е")
+    return frozenset(t for t in re.findall(r"\w+", text) if t not in PROMPT_STOPWORDS)
+
+
+def prompt_fingerprint(text: str) -> Optional[tuple]:
+    """
+    (хэши слов, MinHash подпись) текста запроса - считается один раз на запрос
+    и передается в find и add. None - в тексте нет значимых слов
+    """
+    tokens = prompt_tokens(text)
+    if not tokens:
+        return None
+    hashes = sorted(
+        int.from_bytes(hashlib.blake2b(t.encode("utf-8"), digest_size=8).digest(), "big")
+        for t in tokens
+    )[:SIMILAR_MAX_TOKENS]
+    signature = [min((a * h + b) % _MINHASH_PRIME for h in hashes) for a, b in _MINHASH_PARAMS]
+    return frozenset(hashes), signature
+
+
+class SimilarPromptIndex:
+    """
+    LSH-индекс прошлых генераций по MinHash подписи текста запроса.
+    Индекс разделен по (стиль, размер, качество): похожий текст в другом
+    стиле - другое изображение. Записи ссылаются на ключи кэша генераций.
+    """
+
+    def __init__(self, max_size: int, threshold: float):
+        self.max_size = max_size
+        self.threshold = threshold
+        # cache_key -> (раздел, хэши слов, ключи полос)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._buckets = {}
+        self.hits = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _band_keys(partition: tuple, signature: list) -> list:
+        return [
+            (partition, band, tuple(signature[band * SIMILAR_ROWS:(band + 1) * SIMILAR_ROWS]))
+            for band in range(SIMILAR_BANDS)
+        ]
+
+    def add(self, fingerprint: Optional[tuple], partition: tuple, cache_key: str):
+        if fingerprint is None or cache_key in self._entries:
+            return
+        tokens, signature = fingerprint
+        band_keys = self._band_keys(partition, signature)
+        self._entries[cache_key] = (partition, tokens, band_keys)
+        for band_key in band_keys:
+            self._buckets.setdefault(band_key, set()).add(cache_key)
+        while len(self._entries) > self.max_size:
+            self.remove(next(iter(self._entries)))
+
+    def remove(self, cache_key: str):
+        entry = self._entries.pop(cache_key, None)
+        if entry is None:
+            return
+        for band_key in entry[2]:
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(cache_key)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def find(self, fingerprint: Optional[tuple], partition: tuple) -> list:
+        """Похожие генерации: [(сходство, cache_key)] по убыванию сходства"""
+        if fingerprint is None or not self._entries:
+            return []
+        tokens, signature = fingerprint
+        candidates = set()
+        for band_key in self._band_keys(partition, signature):
+            candidates.update(self._buckets.get(band_key, ()))
+        matches = []
+        for cache_key in candidates:
+            other = self._entries[cache_key][1]
+            score = len(tokens & other) / len(tokens | other)
+            if score >= self.threshold:
+                matches.append((score, cache_key))
+        matches.sort(reverse=True)
+        return matches
+
+
+similar_prompts = SimilarPromptIndex(SIMILAR_INDEX_SIZE, SIMILAR_PROMPT_THRESHOLD)
+
+# ========== ОБЪЕДИНЕНИЕ ОДИНАКОВЫХ ЗАПРОСОВ (SINGLE-FLIGHT) ==========
+
+class SingleFlight:
+    """
+    Объединение одинаковых запросов, выполняющихся одновременно.
+    Первый запрос делает вызов upstream, остальные получают его результат
+    или его ошибку. Ошибка передается только запросам с тем же API ключом:
+    чужой неверный ключ не должен превращать запрос в fallback.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self.coalesced = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._inflight)
+
+    async def do(self, key: str, owner: str, fn) -> tuple:
+        """Возвращает (результат, был ли запрос присоединен к чужому вызову)"""
+        while True:
+            current = self._inflight.get(key)
+            if current is None:
+                return await self._lead(key, owner, fn), False
+
+            future, leader = current
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(future), True
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise  # Отменен сам ожидающий запрос
+                # Первый запрос был отменен (клиент отключился) - пробуем снова
+            except Exception:
+                if leader == owner:
+                    raise
+                return await self._lead(key, owner, fn), False
+
+    async def _lead(self, key: str, owner: str, fn):
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = (future, owner)
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Помечаем исключение полученным, если ожидающих нет
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            if self._inflight.get(key, (None,))[0] is future:
+                del self._inflight[key]
+
+
+generation_flight = SingleFlight()
+
+# Время жизни блокировки генерации в общем хранилище (больше бюджета на генерацию)
+SHARED_FLIGHT_LOCK_TTL = float(os.getenv("SHARED_FLIGHT_LOCK_TTL", "150"))
+# Как часто воркер, ожидающий чужую генерацию, проверяет результат
+SHARED_FLIGHT_POLL_INTERVAL = float(os.getenv("SHARED_FLIGHT_POLL_INTERVAL", "0.5"))
+
+
+class SharedFlight:
+    """
+    Объединение одинаковых генераций между процессами. Первый воркер
+    захватывает ключ в общем хранилище (запись только при отсутствии ключа),
+    остальные опрашивают кэш генераций до появления результата.
+    Если захвативший воркер закончил без результата (ошибка, падение,
+    истек TTL блокировки) - ожидающий делает вызов сам.
+    """
+
+    def __init__(self, cache: GenerationCache, backend_factory, lock_ttl: float, poll_interval: float):
+        self.cache = cache
+        self.backend_factory = backend_factory
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+        self.coalesced = 0
+
+    async def do(self, key: str, fn) -> tuple:
+        """Возвращает (результат, получен ли он от другого воркера)"""
+        backend = self.backend_factory()
+        lock_key = f"flight:{key}"
+        try:
+            acquired = await backend.add(lock_key, {"pid": os.getpid()}, self.lock_ttl)
+        except Exception as e:
+            logger.warning("Общее хранилище недоступно, генерация без блокировки: %s", e)
+            return await fn(), False
+
+        if acquired:
+            try:
+                return await fn(), False
+            finally:
+                try:
+                    await backend.delete(lock_key)
+                except Exception as e:
+                    logger.warning("Не удалось снять блокировку генерации: %s", e)
+
+        result = await self._wait(backend, key, lock_key)
+        if result is not None:
+            self.coalesced += 1
+            return result, True
+        return await fn(), False
+
+    async def _wait(self, backend, key: str, lock_key: str) -> Optional[dict]:
+        deadline = time.monotonic() + self.lock_ttl
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                result = await self.cache.peek_shared(key)
+                if result is not None:
+                    return result
+                if await backend.get(lock_key) is None:
+                    # Результат записывается до снятия блокировки - проверяем еще раз
+                    return await self.cache.peek_shared(key)
+            except Exception as e:
+                logger.warning("Ошибка ожидания генерации другого воркера: %s", e)
+                return None
+        return None
+
+
+shared_flight = SharedFlight(
+    generation_cache, get_state_backend, SHARED_FLIGHT_LOCK_TTL, SHARED_FLIGHT_POLL_INTERVAL
+)
+
+# ========== ЗАЩИТА UPSTREAM: ЛИМИТЫ, ПОВТОРЫ, КОНКУРЕНТНОСТЬ ==========
+
+# Фиксированный лимит изображений в минуту на один API ключ. 0 (по умолчанию) -
+# лимит ключа берется из заголовков x-ratelimit-*-requests ответов OpenAI:
+# у ключей разный tier, а остаток в заголовке общий для всех воркеров
+OPENAI_IMAGES_PER_MINUTE = float(os.getenv("OPENAI_IMAGES_PER_MINUTE", "0"))
+OPENAI_IMAGES_BURST = int(os.getenv("OPENAI_IMAGES_BURST", "0"))
+# Общий бюджет времени на генерацию с учетом ожидания лимитов и повторов
+OPENAI_RETRY_DEADLINE = float(os.getenv("OPENAI_RETRY_DEADLINE", "90"))
+OPENAI_MAX_ATTEMPTS = int(os.getenv("OPENAI_MAX_ATTEMPTS", "4"))
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "1"))
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "20"))
+# Адаптивный лимит одновременных вызовов DALL-E
+UPSTREAM_CONCURRENCY_MIN = int(os.getenv("UPSTREAM_CONCURRENCY_MIN", "2"))
+UPSTREAM_CONCURRENCY_MAX = int(os.getenv("UPSTREAM_CONCURRENCY_MAX", "64"))
+UPSTREAM_CONCURRENCY_INITIAL = int(os.getenv("UPSTREAM_CONCURRENCY_INITIAL", "16"))
+# Если генерация дольше этого порога, лимит перестает расти
+UPSTREAM_LATENCY_TARGET = float(os.getenv("UPSTREAM_LATENCY_TARGET", "40"))
+RATE_LIMITER_MAX_KEYS = 10000
+
+
+class UpstreamRateLimited(Exception):
+    """Локальный лимит не позволяет выполнить вызов до истечения срока запроса"""
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше burst в запасе"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Резервирует токен и возвращает, сколько секунд нужно подождать"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def update(self, per_minute: float, remaining: Optional[int]):
+        """Лимит и остаток, сообщенные OpenAI (остаток учитывает вызовы всех воркеров)"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.rate = per_minute / 60
+        self.burst = max(1, int(per_minute))
+        self.tokens = min(self.tokens, self.burst)
+        if remaining is not None:
+            self.tokens = min(self.tokens, remaining)
+
+
+def parse_rate_limit_headers(headers) -> Optional[tuple]:
+    """(лимит в минуту, остаток) из x-ratelimit-limit-requests / x-ratelimit-remaining-requests"""
+    try:
+        limit = float(headers["x-ratelimit-limit-requests"])
+    except (KeyError, ValueError):
+        return None
+    try:
+        remaining = int(headers["x-ratelimit-remaining-requests"])
+    except (KeyError, ValueError):
+        remaining = None
+    return (limit, remaining) if limit > 0 else None
+
+
+class KeyedRateLimiter:
+    """
+    Отдельный token bucket на каждый (хэшированный) API ключ.
+    per_minute > 0 - фиксированный лимит для всех ключей; иначе ключ не ограничивается,
+    пока OpenAI не сообщит его лимит в заголовках ответа (см. observe)
+    """
+
+    def __init__(self, per_minute: float, burst: int, max_keys: int):
+        self.fixed = per_minute > 0
+        self.rate = per_minute / 60
+        self.burst = burst or max(1, int(per_minute))
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    def _remember(self, key_hash: str, bucket: TokenBucket):
+        self._buckets[key_hash] = bucket
+        self._buckets.move_to_end(key_hash)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+
+    def observe(self, key_hash: str, headers):
+        """Обновление лимита ключа по заголовкам ответа OpenAI (успешного или 429)"""
+        if self.fixed or headers is None:
+            return
+        parsed = parse_rate_limit_headers(headers)
+        if parsed is None:
+            return
+        per_minute, remaining = parsed
+        bucket = self._buckets.get(key_hash)
+        if bucket is None:
+            bucket = TokenBucket(per_minute / 60, max(1, int(per_minute)))
+        bucket.update(per_minute, remaining)
+        self._remember(key_hash, bucket)
+
+    async def acquire(self, key_hash: str, deadline: float):
+        bucket = self._buckets.get(key_hash)
+        if bucket is None:
+            if not self.fixed:
+                return  # Лимит ключа еще неизвестен
+            bucket = TokenBucket(self.rate, self.burst)
+        self._remember(key_hash, bucket)
+
+        wait = bucket.reserve()
+        if wait <= 0:
+            return
+        if time.monotonic() + wait > deadline:
+            bucket.refund()
+            raise UpstreamRateLimited(f"Local rate limit: следующий слот через {wait:.1f} с")
+        await asyncio.sleep(wait)
+
+    def refund(self, key_hash: str):
+        """Возврат токена, если зарезервированный вызов так и не состоялся"""
+        bucket = self._buckets.get(key_hash)
+        if bucket is not None:
+            bucket.refund()
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Лимит одновременных вызовов upstream по схеме AIMD: лимит медленно растет,
+    пока вызовы успешны и быстры, и резко снижается при 429 и таймаутах.
+    """
+
+    def __init__(self, minimum: int, maximum: int, initial: int, latency_target: float):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self._changed = asyncio.Condition()
+
+    async def acquire(self, deadline: float):
+        async with self._changed:
+            timeout = deadline - time.monotonic()
+            try:
+                await asyncio.wait_for(
+                    self._changed.wait_for(lambda: self.in_flight < int(self.limit)), timeout
+                )
+            except asyncio.TimeoutError:
+                raise UpstreamRateLimited("Concurrency limit: нет свободных слотов до истечения срока")
+            self.in_flight += 1
+
+    async def release(self, latency: float, overloaded: bool):
+        # Счетчик и лимит меняются до ожидания блокировки: слот не теряется,
+        # даже если вызывающая задача будет отменена повторно
+        self.in_flight -= 1
+        if overloaded:
+            self.limit = max(self.minimum, self.limit * 0.7)
+        elif latency < self.latency_target:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        async with self._changed:
+            self._changed.notify_all()
+
+
+image_rate_limiter = KeyedRateLimiter(OPENAI_IMAGES_PER_MINUTE, OPENAI_IMAGES_BURST, RATE_LIMITER_MAX_KEYS)
+upstream_concurrency = AdaptiveConcurrencyLimiter(
+    UPSTREAM_CONCURRENCY_MIN, UPSTREAM_CONCURRENCY_MAX, UPSTREAM_CONCURRENCY_INITIAL, UPSTREAM_LATENCY_TARGET
+)
+upstream_retries = 0
+
+
+def is_transient_error(error: Exception) -> bool:
+    """Ошибки, после которых имеет смысл повторить вызов"""
+    openai = load_openai()
+    if isinstance(error, openai.RateLimitError):
+        # 429 из-за исчерпанной квоты не пройдет от повтора
+        return not any(word in str(error) for word in ("quota", "billing"))
+    return isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError))
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Значение Retry-After (или retry-after-ms) из ответа OpenAI"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        if "retry-after-ms" in response.headers:
+            return float(response.headers["retry-after-ms"]) / 1000
+        if "retry-after" in response.headers:
+            return float(response.headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+async def call_images_api(api_key: str, rate_reserved: bool = False, **params):
+    """
+    Вызов DALL-E с лимитом на ключ, адаптивной конкурентностью и повторами
+    транзиентных ошибок (экспоненциальная задержка с jitter, Retry-After).
+    rate_reserved - токен для первой попытки уже получен вызывающим кодом.
+    Исключение выбрасывается только когда повторы или срок исчерпаны.
+    """
+    global upstream_retries
+    openai = load_openai()
+    key_hash = hash_api_key(api_key)
+    deadline = time.monotonic() + OPENAI_RETRY_DEADLINE
+    client = openai_clients.get(api_key)
+
+    for attempt in range(1, OPENAI_MAX_ATTEMPTS + 1):
+        if attempt > 1 or not rate_reserved:
+            await image_rate_limiter.acquire(key_hash, deadline)
+        await upstream_concurrency.acquire(deadline)
+        started = time.monotonic()
+        error = None
+        transient = overloaded = False  # Отмена (клиент отключился) не говорит о перегрузке
+        try:
+            timeout = max(1.0, min(UPSTREAM_READ_TIMEOUT, deadline - started))
+            try:
+                raw = await client.images.with_raw_response.generate(timeout=timeout, **params)
+            finally:
+                # Этап upstream - только сам вызов DALL-E, без очередей, лимитов и пауз
+                GENERATE_STAGE_DURATION.observe(time.monotonic() - started, "upstream")
+            image_rate_limiter.observe(key_hash, raw.headers)
+            response = raw.parse()
+        except Exception as e:
+            error = e
+            error_response = getattr(e, "response", None)
+            image_rate_limiter.observe(key_hash, error_response.headers if error_response is not None else None)
+            transient = is_transient_error(e)
+            overloaded = transient and isinstance(e, (openai.RateLimitError, openai.APITimeoutError))
+        finally:
+            # Слот возвращается при любом исходе, в том числе при отмене задачи
+            await upstream_concurrency.release(time.monotonic() - started, overloaded)
+        if error is None:
+            return response
+        if not transient or attempt == OPENAI_MAX_ATTEMPTS:
+            raise error
+
+        backoff = random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** (attempt - 1)))
+        delay = max(backoff, retry_after_seconds(error) or 0)
+        if time.monotonic() + delay >= deadline:
+            raise error
+        upstream_retries += 1
+        logger.warning("Повтор вызова DALL-E через %.1f с (попытка %s): %s", delay, attempt + 1, error)
+        await asyncio.sleep(delay)
+
+# ========== CIRCUIT BREAKER И КЭШ ОШИБОК ==========
+
+# Ошибки, которые не исчезнут от повтора: результат запоминается на NEGATIVE_CACHE_TTL
+DETERMINISTIC_ERRORS = ("auth_error", "billing_issue", "region_restriction")
+NEGATIVE_CACHE_TTL = float(os.getenv("NEGATIVE_CACHE_TTL", "300"))
+# Circuit breaker для транзиентных ошибок (rate_limit, timeout, unknown_error)
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "3"))
+GLOBAL_BREAKER_FAILURE_THRESHOLD = int(os.getenv("GLOBAL_BREAKER_FAILURE_THRESHOLD", "20"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+BREAKER_HALF_OPEN_PROBES = int(os.getenv("BREAKER_HALF_OPEN_PROBES", "1"))
+BREAKER_MAX_KEYS = 10000
+
+
+class UpstreamShortCircuit(Exception):
+    """
+    Вызов OpenAI пропущен: известно, что он завершится ошибкой.
+    Текст исключения - исходная ошибка, error_type - ее тип, если он известен.
+    """
+
+    def __init__(self, error_msg: str, error_type: Optional[str] = None):
+        super().__init__(error_msg)
+        self.error_type = error_type
+
+
+REGION_ERROR_CODES = ("unsupported_country_region_territory", "unsupported_country")
+
+
+def deterministic_error_type(error: Exception) -> Optional[str]:
+    """
+    Тип детерминированной ошибки - только по классу исключения и коду ответа,
+    а не по тексту: 400 (например, content_policy_violation) к ключу не относится
+    """
+    openai = load_openai()
+    code = getattr(error, "code", None) or ""
+    if isinstance(error, openai.AuthenticationError):
+        return "auth_error"
+    if isinstance(error, openai.PermissionDeniedError) and code in REGION_ERROR_CODES:
+        return "region_restriction"
+    if isinstance(error, openai.RateLimitError) and code == "insufficient_quota":
+        return "billing_issue"
+    return None
+
+
+def is_request_error(error: Exception) -> bool:
+    """Ошибка конкретного запроса (4xx, кроме 429): не говорит о состоянии ключа или upstream"""
+    openai = load_openai()
+    return (isinstance(error, openai.APIStatusError)
+            and 400 <= error.status_code < 500 and error.status_code != 429)
+
+
+class CircuitBreaker:
+    """
+    closed - вызовы проходят; open - после серии ошибок вызовы блокируются;
+    half_open - по истечении reset_timeout пропускается несколько пробных вызовов
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float, half_open_probes: int):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes = 0
+        self.probe_started_at = 0.0
+        self.last_error = ""
+        self.last_error_type = "unknown_error"
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        if self.state == "open":
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            self.state = "half_open"
+            self.probes = 0
+        if self.state == "half_open":
+            # Пробный вызов, не сообщивший результат за reset_timeout, считается потерянным
+            if self.probes >= self.half_open_probes and now - self.probe_started_at < self.reset_timeout:
+                return False
+            if self.probes >= self.half_open_probes:
+                self.probes = 0
+            self.probes += 1
+            self.probe_started_at = now
+        return True
+
+    def is_probing(self) -> bool:
+        return self.state == "half_open" and self.probes > 0
+
+    def release_probe(self):
+        """Возврат пробного слота, если вызов завершился без результата для breaker'а"""
+        if self.is_probing():
+            self.probes -= 1
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.probes = 0
+
+    def record_failure(self, error_msg: str, error_type: str):
+        self.last_error = error_msg
+        self.last_error_type = error_type
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.probes = 0
+
+    def snapshot(self) -> dict:
+        data = {"state": self.state, "failures": self.failures}
+        if self.state != "closed":
+            data["retry_in"] = round(max(0.0, self.opened_at + self.reset_timeout - time.monotonic()), 1)
+            data["last_error_type"] = self.last_error_type
+        return data
+
+
+class UpstreamGuard:
+    """
+    Защита от заведомо неудачных вызовов OpenAI на основе error_type:
+    кэш детерминированных ошибок по ключу (и региональной блокировки - глобально),
+    а также circuit breaker на ключ и общий breaker для всего upstream.
+    """
+
+    def __init__(self):
+        self._negative: "OrderedDict[str, tuple]" = OrderedDict()
+        self._region_block: Optional[tuple] = None
+        self._breakers: "OrderedDict[str, CircuitBreaker]" = OrderedDict()
+        self.global_breaker = CircuitBreaker(
+            GLOBAL_BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT, BREAKER_HALF_OPEN_PROBES
+        )
+        self.short_circuited = 0
+
+    def check_cached_error(self, key_hash: str):
+        """Выбрасывает UpstreamShortCircuit, если для ключа запомнена детерминированная ошибка"""
+        now = time.monotonic()
+        # Ограничение по региону относится к серверу, а не к ключу
+        if self._region_block is not None:
+            if self._region_block[0] > now:
+                self._short_circuit(*self._region_block[1:])
+            self._region_block = None
+
+        entry = self._negative.get(key_hash)
+        if entry is not None:
+            if entry[0] > now:
+                self._short_circuit(*entry[1:])
+            del self._negative[key_hash]
+
+    def before_call(self, key_hash: str) -> list:
+        """
+        Проверка breaker'ов непосредственно перед вызовом upstream.
+        Возвращает breaker'ы, выдавшие пробный слот: их нужно передать в release_probes
+        """
+        probes = []
+        breaker = self._breakers.get(key_hash)
+        if breaker is not None:
+            if not breaker.allow():
+                self._short_circuit(breaker.last_error, breaker.last_error_type)
+            if breaker.is_probing():
+                probes.append(breaker)
+        if not self.global_breaker.allow():
+            self.release_probes(probes)
+            self._short_circuit(self.global_breaker.last_error, self.global_breaker.last_error_type)
+        if self.global_breaker.is_probing():
+            probes.append(self.global_breaker)
+        return probes
+
+    @staticmethod
+    def release_probes(probes: list):
+        """
+        Вызывается всегда после вызова upstream. Если результат не записан
+        (локальный лимит, отмена, детерминированная ошибка), слот возвращается,
+        иначе half_open не пропустил бы больше ни одного вызова
+        """
+        for breaker in probes:
+            breaker.release_probe()
+
+    def record(self, key_hash: str, error: Optional[Exception]):
+        if error is None:
+            self.global_breaker.record_success()
+            breaker = self._breakers.pop(key_hash, None)
+            if breaker is not None:
+                breaker.record_success()
+            return
+
+        error_msg = str(error)
+        error_type = deterministic_error_type(error)
+        if error_type == "region_restriction":
+            self._region_block = (time.monotonic() + NEGATIVE_CACHE_TTL, error_msg, error_type)
+        elif error_type in DETERMINISTIC_ERRORS:
+            self._negative[key_hash] = (time.monotonic() + NEGATIVE_CACHE_TTL, error_msg, error_type)
+            self._negative.move_to_end(key_hash)
+            while len(self._negative) > BREAKER_MAX_KEYS:
+                self._negative.popitem(last=False)
+        elif not is_request_error(error):
+            error_type = classify_error(error)[0]
+            breaker = self._breakers.pop(key_hash, None) or CircuitBreaker(
+                BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT, BREAKER_HALF_OPEN_PROBES
+            )
+            self._breakers[key_hash] = breaker
+            while len(self._breakers) > BREAKER_MAX_KEYS:
+                self._breakers.popitem(last=False)
+            breaker.record_failure(error_msg, error_type)
+            self.global_breaker.record_failure(error_msg, error_type)
+
+    def _short_circuit(self, error_msg: str, error_type: Optional[str] = None):
+        self.short_circuited += 1
+        raise UpstreamShortCircuit(error_msg, error_type)
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        open_keys = {
+            key_hash[:12]: breaker.snapshot()
+            for key_hash, breaker in self._breakers.items()
+            if breaker.state != "closed"
+        }
+        return {
+            "global": self.global_breaker.snapshot(),
+            "open_keys": open_keys,
+            "cached_errors": sum(1 for entry in self._negative.values() if entry[0] > now),
+            "region_blocked": self._region_block is not None and self._region_block[0] > now,
+            "short_circuited": self.short_circuited
+        }
+
+
+upstream_guard = UpstreamGuard()
+
+# ========== ПРОВЕРКА API КЛЮЧЕЙ ==========
+
+KEY_VALIDATION_TTL = float(os.getenv("KEY_VALIDATION_TTL", "300"))
+KEY_VALIDATION_TIMEOUT = float(os.getenv("KEY_VALIDATION_TIMEOUT", "10"))
+KEY_VALIDATION_MAX_KEYS = 10000
+
+
+class KeyValidationCache:
+    """Результаты проверки ключей по хэшу ключа (общие для /test-openai и /generate)"""
+
+    def __init__(self, ttl: float, max_keys: int):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, key_hash: str) -> Optional[dict]:
+        entry = self._entries.get(key_hash)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._entries[key_hash]
+            return None
+        return entry[1]
+
+    def set(self, key_hash: str, validation: dict):
+        self._entries[key_hash] = (time.monotonic() + self.ttl, validation)
+        self._entries.move_to_end(key_hash)
+        while len(self._entries) > self.max_keys:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+key_validation_cache = KeyValidationCache(KEY_VALIDATION_TTL, KEY_VALIDATION_MAX_KEYS)
+# Ключи, с которыми недавно прошла успешная генерация
+verified_keys = KeyValidationCache(KEY_VALIDATION_TTL, KEY_VALIDATION_MAX_KEYS)
+key_validation_flight = SingleFlight()
+
+
+async def probe_api_key(api_key: str) -> dict:
+    """
+    Легкая проверка ключа: один запрос GET /models/dall-e-3 вместо списка всех моделей.
+    404 означает, что ключ рабочий, но доступа к DALL-E 3 нет.
+    """
+    openai = load_openai()
+    client = openai_clients.get(api_key)
+    try:
+        raw = await client.models.with_raw_response.retrieve("dall-e-3", timeout=KEY_VALIDATION_TIMEOUT)
+    except openai.NotFoundError as e:
+        return {"valid": True, "dall_e_available": False,
+                "organization": e.response.headers.get("openai-organization"), "error": str(e)}
+    except (openai.AuthenticationError, openai.PermissionDeniedError) as e:
+        return {"valid": False, "dall_e_available": False, "organization": None, "error": str(e)}
+    return {"valid": True, "dall_e_available": True,
+            "organization": raw.headers.get("openai-organization"), "error": None}
+
+
+async def validate_api_key(api_key: str) -> tuple:
+    """(результат проверки, взят ли он из кэша); транзиентные ошибки пробрасываются"""
+    key_hash = hash_api_key(api_key)
+    validation = key_validation_cache.get(key_hash)
+    if validation is not None:
+        return validation, True
+
+    async def probe() -> dict:
+        result = await probe_api_key(api_key)
+        key_validation_cache.set(key_hash, result)
+        return result
+
+    # Параллельные проверки одного ключа (несколько вкладок настроек) - один запрос
+    validation, _ = await key_validation_flight.do(key_hash, key_hash, probe)
+    return validation, False
+
+
+def check_validated_key(key_hash: str):
+    """Отклонение ключа, который проверка уже признала нерабочим для DALL-E"""
+    validation = key_validation_cache.get(key_hash)
+    if validation is not None and not (validation["valid"] and validation["dall_e_available"]):
+        upstream_guard.short_circuited += 1
+        raise UpstreamShortCircuit(validation["error"])
+
+
+async def key_may_use_cache(api_key: str, key_hash: str) -> bool:
+    """
+    Готовые изображения (кэш и похожие промпты) отдаются только ключу, подтвержденному
+    проверкой или успешной генерацией, иначе любой непустой api_key получал бы
+    чужие результаты в режиме openai. Неподтвержденный ключ проверяется одним
+    легким запросом; нерабочий ключ уходит в fallback, при сбое проверки - генерация
+    """
+    validation = key_validation_cache.get(key_hash)
+    if validation is not None and validation["valid"] and validation["dall_e_available"]:
+        return True
+    if verified_keys.get(key_hash) is not None:
+        return True
+    try:
+        await validate_api_key(api_key)
+    except Exception as e:
+        logger.debug("Не удалось проверить ключ перед выдачей из кэша: %s", e)
+        return False
+    check_validated_key(key_hash)
+    return True
+
+# ========== ДОПУСК ГЕНЕРАЦИЙ И ПРИОРИТЕТЫ ==========
+
+# Сколько генераций одновременно обращаются к DALL-E (остальные ждут в очереди).
+# Допуск следует адаптивному лимиту upstream_concurrency; значение > 0 дополнительно его ограничивает
+GENERATION_MAX_ACTIVE = int(os.getenv("GENERATION_MAX_ACTIVE", "0"))
+# Предел очереди: сверх него запрос сразу получает 429 с Retry-After
+GENERATION_QUEUE_MAX = int(os.getenv("GENERATION_QUEUE_MAX", "100"))
+# Доля очереди, доступная обычным запросам: остаток всегда свободен для high
+GENERATION_QUEUE_NORMAL_SHARE = float(os.getenv("GENERATION_QUEUE_NORMAL_SHARE", "0.8"))
+# Максимальное ожидание в очереди для интерактивных запросов
+GENERATION_QUEUE_TIMEOUT = float(os.getenv("GENERATION_QUEUE_TIMEOUT", "30"))
+# Начальная оценка времени генерации, пока нет измерений (секунды)
+GENERATION_SERVICE_TIME_INITIAL = float(os.getenv("GENERATION_SERVICE_TIME_INITIAL", "15"))
+# SHA-256 хэши оплаченных ключей через запятую (как в hash_api_key) - высокий приоритет
+PRIORITY_KEY_HASHES = frozenset(
+    h.strip().lower() for h in os.getenv("PRIORITY_KEY_HASHES", "").split(",") if h.strip()
+)
+# high - hd и оплаченные ключи, normal - остальные запросы с ключом,
+# background - задачи /jobs: ждут без предела очереди и без таймаута
+GENERATION_PRIORITIES = {"high": 0, "normal": 1, "background": 2}
+
+
+class AdmissionRejected(Exception):
+    """Очередь генераций переполнена или ожидание превысило предел"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def generation_priority(request: GenerateRequest, key_hash: str, background: bool = False) -> str:
+    if background:
+        return "background"
+    if request.quality == "hd" or key_hash in PRIORITY_KEY_HASHES:
+        return "high"
+    return "normal"
+
+
+class GenerationScheduler:
+    """
+    Допуск генераций к upstream: одновременно не больше текущего адаптивного лимита
+    (и max_active_cap, если задан), остальные ждут в очереди по приоритету
+    (внутри класса - по порядку прихода). Так ожидание свободного вызова всегда
+    видно в глубине очереди и ограничено ее пределом и таймаутом.
+    Демо-режим, попадания в кэш и присоединенные запросы сюда не попадают.
+    Время обслуживания измеряется (EWMA) и используется для Retry-After.
+    """
+
+    def __init__(self, concurrency: AdaptiveConcurrencyLimiter, max_active_cap: int,
+                 max_queue: int, queue_timeout: float, service_time: float):
+        self.concurrency = concurrency
+        self.max_active_cap = max_active_cap
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.service_time = service_time
+        self._measured = False
+        self.queue_limits = {
+            "high": max_queue,
+            "normal": max(1, int(max_queue * GENERATION_QUEUE_NORMAL_SHARE))
+        }
+        self.active = 0
+        self._heap = []
+        self._sequence = 0
+        self.waiting = {name: 0 for name in GENERATION_PRIORITIES}
+        self.rejected = {name: 0 for name in GENERATION_PRIORITIES}
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(self.waiting.values())
+
+    @property
+    def max_active(self) -> int:
+        limit = int(self.concurrency.limit)
+        return min(limit, self.max_active_cap) if self.max_active_cap > 0 else limit
+
+    def retry_after(self) -> int:
+        """Оценка, через сколько секунд освободится место в очереди"""
+        estimate = (self.queue_depth + 1) * self.service_time / max(1, self.max_active)
+        return max(1, int(estimate + 0.999))
+
+    async def acquire(self, priority: str) -> float:
+        """Ожидание слота; возвращает время ожидания в секундах"""
+        if self.active < self.max_active and not self.queue_depth:
+            self.active += 1
+            return 0.0
+        background = priority == "background"
+        if not background and self.queue_depth >= self.queue_limits[priority]:
+            self.rejected[priority] += 1
+            raise AdmissionRejected("Очередь генераций переполнена", self.retry_after())
+
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self._sequence += 1
+        heapq.heappush(self._heap, (GENERATION_PRIORITIES[priority], self._sequence, future))
+        self.waiting[priority] += 1
+        # Таймер вместо wait_for: отмена запроса не должна теряться,
+        # даже если слот был передан ему в тот же момент
+        timer = None
+        if not background:
+            timer = asyncio.get_running_loop().call_later(
+                self.queue_timeout,
+                lambda: future.done() or future.set_exception(asyncio.TimeoutError())
+            )
+        try:
+            await future
+        except asyncio.TimeoutError:
+            self.rejected[priority] += 1
+            raise AdmissionRejected("Превышено время ожидания в очереди генераций", self.retry_after())
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._hand_over()  # Слот уже передан отмененному запросу - отдаем дальше
+            raise
+        finally:
+            self.waiting[priority] -= 1
+            if timer is not None:
+                timer.cancel()
+        return time.monotonic() - started
+
+    def release(self, service_time: float):
+        if self._measured:
+            self.service_time = 0.8 * self.service_time + 0.2 * service_time
+        else:
+            self.service_time = service_time  # Первое измерение заменяет начальную оценку
+            self._measured = True
+        self._hand_over()
+
+    def _hand_over(self):
+        # Слот переходит первому живому ожидающему, счетчик active не меняется.
+        # После снижения лимита слот освобождается, после роста - допускаются еще ожидающие
+        self.active -= 1
+        while self._heap and self.active < self.max_active:
+            _, _, future = heapq.heappop(self._heap)
+            if not future.done():
+                future.set_result(None)
+                self.active += 1
+
+    def snapshot(self) -> dict:
+        return {
+            "active": self.active,
+            "max_active": self.max_active,
+            "queue_depth": self.queue_depth,
+            "queue_max": self.max_queue,
+            "waiting": dict(self.waiting),
+            "rejected": dict(self.rejected),
+            "service_time_s": round(self.service_time, 2)
+        }
+
+
+generation_scheduler = GenerationScheduler(
+    upstream_concurrency, GENERATION_MAX_ACTIVE, GENERATION_QUEUE_MAX, GENERATION_QUEUE_TIMEOUT, GENERATION_SERVICE_TIME_INITIAL
+)
+
+# ========== ЛОКАЛЬНОЕ ХРАНИЛИЩЕ ИЗОБРАЖЕНИЙ ==========
+
+# Сгенерированные изображения скачиваются один раз и раздаются сервером:
+# ссылки OpenAI живут около часа, а PNG весит несколько мегабайт
+IMAGE_STORE_ENABLED = os.getenv("IMAGE_STORE_ENABLED", "1") == "1"
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "image_store")
+IMAGE_DOWNLOAD_TIMEOUT = float(os.getenv("IMAGE_DOWNLOAD_TIMEOUT", "30"))
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(20 * 1024 * 1024)))
+IMAGE_PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", "2"))
+# Предел размера хранилища (0 - без предела): сверх него в фоне удаляются
+# давно не запрошенные изображения вместе с вариантами
+IMAGE_STORE_MAX_BYTES = int(os.getenv("IMAGE_STORE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+IMAGE_STORE_PRUNE_INTERVAL = float(os.getenv("IMAGE_STORE_PRUNE_INTERVAL", "600"))
+# mtime оригинала обновляется при обращении не чаще, чем раз в столько секунд
+IMAGE_STORE_TOUCH_INTERVAL = 3600
+IMAGE_VARIANT_WIDTHS = (256, 512, 1024)
+# расширение -> (формат Pillow, MIME тип)
+IMAGE_VARIANT_FORMATS = {"webp": ("WEBP", "image/webp"), "jpg": ("JPEG", "image/jpeg")}
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Базовый адрес для абсолютных ссылок (Render выставляет RENDER_EXTERNAL_URL сам)
+PUBLIC_BASE_URL = (os.getenv("PUBLIC_BASE_URL") or os.getenv("RENDER_EXTERNAL_URL", "")).rstrip("/")
+
+
+def public_url(path: str, base_url: str = "") -> str:
+    """Абсолютная ссылка: от PUBLIC_BASE_URL, а без него - от адреса, на который пришел запрос"""
+    return f"{PUBLIC_BASE_URL or base_url}{path}"
+
+
+def request_base_url(http_request: Request) -> str:
+    return str(http_request.base_url).rstrip("/")
+
+
+def render_image_variant(source_path: str, target_path: str, width: int, pil_format: str):
+    """Уменьшение и перекодирование изображения (выполняется в отдельном процессе)"""
+    from PIL import Image
+
+    with Image.open(source_path) as image:
+        image = image.convert("RGB")
+        if image.width > width:
+            height = round(image.height * width / image.width)
+            image = image.resize((width, height), Image.LANCZOS)
+        tmp_path = f"{target_path}.{os.getpid()}.tmp"
+        image.save(tmp_path, pil_format, quality=82, optimize=True)
+    os.replace(tmp_path, target_path)
+
+
+class ImageStore:
+    """
+    Контентно-адресуемое хранилище изображений: файл называется по SHA-256
+    содержимого, поэтому ссылки на него можно кэшировать навсегда.
+    Варианты (WebP/JPEG разных размеров) строятся в пуле процессов.
+    """
+
+    def __init__(self, directory: str, process_workers: int):
+        self.directory = directory
+        self.process_workers = process_workers
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._rendering = {}
+        self._background = set()
+        self._touched = {}
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def is_valid_id(image_id: str) -> bool:
+        return len(image_id) == 64 and all(c in "0123456789abcdef" for c in image_id)
+
+    def original_path(self, image_id: str) -> str:
+        return os.path.join(self.directory, image_id[:2], f"{image_id}.png")
+
+    def variant_path(self, image_id: str, width: int, ext: str) -> str:
+        return os.path.join(self.directory, image_id[:2], f"{image_id}_{width}.{ext}")
+
+    def has(self, image_id: str) -> bool:
+        return os.path.exists(self.original_path(image_id))
+
+    def touch(self, image_id: str):
+        """Отметка обращения: mtime оригинала - давность использования для prune"""
+        now = time.time()
+        if now - self._touched.get(image_id, 0) < IMAGE_STORE_TOUCH_INTERVAL:
+            return
+        self._touched[image_id] = now
+        try:
+            os.utime(self.original_path(image_id))
+        except OSError:
+            pass
+
+    def prune(self, max_bytes: int) -> int:
+        """
+        Удаляет изображения (оригинал и варианты) по давности mtime оригинала,
+        пока хранилище больше max_bytes. Выполняется в потоке; возвращает число удаленных
+        """
+        groups = {}  # image_id -> [mtime оригинала, размер, пути]
+        total = 0
+        stale_tmp = time.time() - IMAGE_STORE_TOUCH_INTERVAL
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.endswith(".tmp") and stat.st_mtime > stale_tmp:
+                    continue  # Файл еще записывается
+                image_id = entry.name[:64]
+                group = groups.setdefault(image_id, [0.0, 0, []])
+                if entry.name == f"{image_id}.png":
+                    group[0] = stat.st_mtime
+                group[1] += stat.st_size
+                group[2].append(entry.path)
+                total += stat.st_size
+
+        removed = 0
+        # Варианты без оригинала (mtime 0) удаляются первыми
+        for image_id, (_, size, paths) in sorted(groups.items(), key=lambda item: item[1][0]):
+            if total <= max_bytes:
+                break
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._touched.pop(image_id, None)
+            total -= size
+            removed += 1
+        return removed
+
+    def urls(self, image_id: str, base_url: str = "") -> dict:
+        """Ссылки на оригинал и все варианты изображения"""
+        return {
+            "original": public_url(f"/images/{image_id}", base_url),
+            **{
+                f"{ext}_{width}": public_url(f"/images/{image_id}/{width}.{ext}", base_url)
+                for ext in IMAGE_VARIANT_FORMATS
+                for width in IMAGE_VARIANT_WIDTHS
+            }
+        }
+
+    async def materialize(self, url: str) -> str:
+        """Скачивает изображение в хранилище и возвращает его image_id"""
+        client = get_upstream_http_client()
+        chunks = []
+        size = 0
+        async with client.stream("GET", url, timeout=IMAGE_DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                if size > IMAGE_MAX_BYTES:
+                    raise ValueError(f"Изображение больше {IMAGE_MAX_BYTES} байт")
+                chunks.append(chunk)
+        data = b"".join(chunks)
+        image_id = hashlib.sha256(data).hexdigest()
+        await asyncio.to_thread(self._write_original, image_id, data)
+
+        # Варианты строятся в фоне, ответ клиенту их не ждет
+        for ext in IMAGE_VARIANT_FORMATS:
+            for width in IMAGE_VARIANT_WIDTHS:
+                task = asyncio.create_task(self._render_quietly(image_id, width, ext))
+                self._background.add(task)
+                task.add_done_callback(self._background.discard)
+        return image_id
+
+    def _write_original(self, image_id: str, data: bytes):
+        path = self.original_path(image_id)
+        if os.path.exists(path):
+            os.utime(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    async def ensure_variant(self, image_id: str, width: int, ext: str) -> str:
+        """Путь к варианту изображения; если его еще нет - строит в пуле процессов"""
+        target = self.variant_path(image_id, width, ext)
+        if os.path.exists(target):
+            return target
+
+        # Один и тот же вариант строится только один раз, даже при параллельных запросах
+        pending = self._rendering.get(target)
+        if pending is None:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.process_workers)
+            loop = asyncio.get_running_loop()
+            pending = loop.run_in_executor(
+                self._pool, render_image_variant,
+                self.original_path(image_id), target, width, IMAGE_VARIANT_FORMATS[ext][0]
+            )
+            self._rendering[target] = pending
+            pending.add_done_callback(lambda _: self._rendering.pop(target, None))
+        await asyncio.shield(pending)
+        return target
+
+    async def _render_quietly(self, image_id: str, width: int, ext: str):
+        try:
+            await self.ensure_variant(image_id, width, ext)
+        except Exception as e:
+            logger.warning("Не удалось построить вариант %s %s.%s: %s", image_id[:12], width, ext, e)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+image_store = ImageStore(IMAGE_STORE_DIR, IMAGE_PROCESS_WORKERS) if IMAGE_STORE_ENABLED else None
+
+
+async def prune_image_store_periodically():
+    """Ограничение размера хранилища: каждые IMAGE_STORE_PRUNE_INTERVAL секунд"""
+    while True:
+        try:
+            removed = await asyncio.to_thread(image_store.prune, IMAGE_STORE_MAX_BYTES)
+            if removed:
+                logger.info("Из хранилища удалено давно не запрошенных изображений: %s", removed)
+        except Exception as e:
+            logger.warning("Не удалось очистить хранилище изображений: %s", e)
+        await asyncio.sleep(IMAGE_STORE_PRUNE_INTERVAL)
+
+
+@app.on_event("startup")
+async def start_image_store_pruning():
+    if image_store is not None and IMAGE_STORE_MAX_BYTES > 0:
+        app.state.image_store_pruning = asyncio.create_task(prune_image_store_periodically())
+
+
+@app.on_event("shutdown")
+async def close_image_store():
+    pruning = getattr(app.state, "image_store_pruning", None)
+    if pruning is not None:
+        pruning.cancel()
+    if image_store is not None:
+        image_store.close()
+
+
+def parse_byte_range(range_header: str, file_size: int) -> Optional[tuple]:
+    """
+    Разбор заголовка Range (поддерживается один диапазон).
+    Возвращает (start, end) включительно или None, если диапазон некорректен.
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start_text, _, end_text = spec.strip().partition("-")
+    try:
+        if start_text:
+            start = int(start_text)
+            end = int(end_text) if end_text else file_size - 1
+        else:
+            # bytes=-N - последние N байт
+            start = max(file_size - int(end_text), 0)
+            end = file_size - 1
+    except ValueError:
+        return None
+    end = min(end, file_size - 1)
+    if start > end or start >= file_size:
+        return None
+    return start, end
+
+
+def read_file_range(path: str, start: int, length: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(length)
+
+
+async def send_stored_file(path: str, media_type: str, etag: str, http_request: Request) -> Response:
+    """
+    Отдача файла из хранилища: ETag/304, Range (206) и потоковая отправка.
+    Содержимое по ссылке никогда не меняется, поэтому кэш бессрочный.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        raise HTTPException(status_code=404, detail={"status": "error", "error": "Изображение не найдено"})
+
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Cache-Control": IMAGE_CACHE_CONTROL,
+        "Accept-Ranges": "bytes"
+    }
+    if_none_match = http_request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in if_none_match):
+        return Response(status_code=304, headers=headers)
+
+    range_header = http_request.headers.get("range")
+    if range_header and http_request.headers.get("if-range", etag) == etag:
+        byte_range = parse_byte_range(range_header, stat.st_size)
+        if byte_range is None:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{stat.st_size}"})
+        start, end = byte_range
+        body = await asyncio.to_thread(read_file_range, path, start, end - start + 1)
+        headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+        return Response(content=body, status_code=206, media_type=media_type, headers=headers)
+
+    return FileResponse(path, media_type=media_type, headers=headers, stat_result=stat)
+
+# ========== ЛОКАЛЬНЫЕ ДЕМО-ЗАГЛУШКИ ==========
+
+# local - заглушки рисуются Pillow и раздаются сервером, unsplash - внешние фото
+DEMO_RENDERER = os.getenv("DEMO_RENDERER", "local")
+DEMO_SIZES = IMAGE_SIZES
+# Масштаб отрисовки относительно запрошенного размера (меньше 1 - файл меньше,
+# но клиент получает изображение не того размера, который запросил)
+DEMO_RENDER_SCALE = float(os.getenv("DEMO_RENDER_SCALE", "1"))
+# Отрисованные заглушки хранятся на диске: воркеры и перезапуски не рисуют их заново
+DEMO_CACHE_DIR = os.getenv("DEMO_CACHE_DIR", "demo_cache")
+# Версия отрисовки входит в ссылку, чтобы сбросить бессрочный кэш клиентов
+DEMO_RENDER_VERSION = 2
+
+
+def render_demo_placeholder(style: str, size: str) -> bytes:
+    """Градиентная заглушка в цветах стиля с подписью (WebP)"""
+    from PIL import Image, ImageDraw, ImageFont, ImageOps
+    import io
+
+    width, height = (max(1, round(int(v) * DEMO_RENDER_SCALE)) for v in size.split('x'))
+    start, end = DEMO_PALETTES.get(style, DEMO_PALETTES["default"])
+    gradient = Image.linear_gradient("L").rotate(45).resize((width, height))
+    image = ImageOps.colorize(gradient, start, end)
+
+    draw = ImageDraw.Draw(image)
+    font_size = max(12, width // 18)
+    try:
+        font = ImageFont.load_default(size=font_size)
+    except (TypeError, OSError):
+        font = ImageFont.load_default()  # Pillow без FreeType
+    label = style.replace("_", " ").upper()
+    draw.text((width / 2 + 2, height / 2 + 2), label, font=font, anchor="mm", fill=(0, 0, 0))
+    draw.text((width / 2, height / 2), label, font=font, anchor="mm", fill=(255, 255, 255))
+
+    buffer = io.BytesIO()
+    image.save(buffer, "WEBP", quality=70)
+    return buffer.getvalue()
+
+
+class DemoRenderer:
+    """
+    Заглушки для демо-режима и fallback: хранятся в памяти, а отрисованные
+    файлы - в DEMO_CACHE_DIR (отрисовка одного набора - несколько секунд CPU)
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._images = {}
+
+    def url(self, style: str, size: str, base_url: str = "") -> str:
+        # size уже проверен моделью запроса, заглушки есть для всех размеров DALL-E
+        style = style if style in STYLES else "default"
+        return public_url(f"/demo/{style}/{size}.webp?v={DEMO_RENDER_VERSION}", base_url)
+
+    def get_cached(self, style: str, size: str) -> Optional[tuple]:
+        return self._images.get((style, size))
+
+    async def get(self, style: str, size: str) -> tuple:
+        """(содержимое, ETag) заглушки; отсутствующая отрисовывается в потоке"""
+        entry = self._images.get((style, size))
+        if entry is None:
+            entry = await asyncio.to_thread(self._render, style, size)
+        return entry
+
+    def path(self, style: str, size: str) -> str:
+        return os.path.join(self.directory, f"{style}-{size}-v{DEMO_RENDER_VERSION}-x{DEMO_RENDER_SCALE:g}.webp")
+
+    def _render(self, style: str, size: str) -> tuple:
+        path = self.path(style, size)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            data = render_demo_placeholder(style, size)
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.warning("Не удалось сохранить демо-заглушку %s: %s", path, e)
+        entry = (data, f'"{hashlib.sha256(data).hexdigest()[:32]}"')
+        self._images[(style, size)] = entry
+        return entry
+
+    def render_all(self):
+        started = time.perf_counter()
+        for style in [*STYLES, "default"]:
+            for size in DEMO_SIZES:
+                if (style, size) not in self._images:
+                    self._render(style, size)
+        logger.info("Демо-заглушки готовы: %s за %.2f с", len(self._images), time.perf_counter() - started)
+
+
+demo_renderer = DemoRenderer(DEMO_CACHE_DIR) if DEMO_RENDERER == "local" else None
+
+
+@app.on_event("startup")
+async def prerender_demo_images():
+    # Отрисовка в фоне: сервер начинает принимать запросы сразу
+    if demo_renderer is not None:
+        app.state.demo_prerender = asyncio.create_task(asyncio.to_thread(demo_renderer.render_all))
+
+# ========== ПРЕДСОБРАННЫЕ СТАТИЧЕСКИЕ ОТВЕТЫ ==========
+
+# Быстрый JSON encoder, если установлен orjson
+try:
+    import orjson
+
+    def dumps_json(data) -> bytes:
+        return orjson.dumps(data)
+except ImportError:
+    def dumps_json(data) -> bytes:
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class StaticPayload:
+    """Готовое тело ответа с заголовками для условных запросов"""
+
+    def __init__(self, body: bytes, media_type: str, built_at: float):
+        self.body = body
+        self.media_type = media_type
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        self.last_modified = formatdate(built_at, usegmt=True)
+        self.built_at = built_at
+        self.headers = {
+            "ETag": self.etag,
+            "Last-Modified": self.last_modified,
+            "Cache-Control": "no-cache"  # Клиент кэширует, но перепроверяет по ETag
+        }
+
+
+class StaticPayloads:
+    """Ответы /, /health, /styles и /info, собранные один раз"""
+
+    def __init__(self):
+        started_at = datetime.now()
+        built_at = time.time()
+        self.pages = {
+            "root": StaticPayload(
+                build_root_html(started_at).encode("utf-8"), "text/html", built_at
+            ),
+            "styles": StaticPayload(
+                dumps_json(build_styles_body(datetime.utcnow())), "application/json", built_at
+            ),
+            "info": StaticPayload(
+                dumps_json(build_info_body(datetime.utcnow())), "application/json", built_at
+            )
+        }
+        # В /health меняется только timestamp: тело собирается из двух готовых частей
+        health = dumps_json(build_health_body())
+        self.health_prefix = b'{"timestamp":"'
+        self.health_suffix = b'",' + health[1:]
+
+
+# STYLES и DEMO_IMAGES не меняются во время работы, поэтому ответы собираются
+# один раз на процесс; новые стили появляются после перезапуска
+_static_payloads: Optional[StaticPayloads] = None
+
+
+def get_static_payloads() -> StaticPayloads:
+    global _static_payloads
+    if _static_payloads is None:
+        _static_payloads = StaticPayloads()
+    return _static_payloads
+
+
+def static_response(name: str, http_request: Request) -> Response:
+    """Отдача предсобранного ответа с поддержкой If-None-Match / If-Modified-Since"""
+    payload = get_static_payloads().pages[name]
+    if_none_match = http_request.headers.get("if-none-match")
+    if if_none_match is not None:
+        not_modified = if_none_match.strip() == "*" or payload.etag in if_none_match
+    else:
+        not_modified = http_request.headers.get("if-modified-since") == payload.last_modified
+    if not_modified:
+        return Response(status_code=304, headers=payload.headers)
+    return Response(content=payload.body, media_type=payload.media_type, headers=payload.headers)
+
+
+@app.on_event("startup")
+async def build_static_responses():
+    get_static_payloads()
+
+# ========== МЕТРИКИ (PROMETHEUS) ==========
+
+# Границы корзин гистограмм (секунды): от быстрых демо-ответов до долгих вызовов DALL-E
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    """
+    Счетчик со значением в памяти или вычисляемый при сборе метрик (collect):
+    так экспортируются счетчики, которые компоненты уже ведут сами
+    """
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.collect = collect
+        self._values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        values = self.collect() if self.collect is not None else self._values
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [счетчики по корзинам (не накопительные), сумма, количество]
+        self._series = {}
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        names = self.labelnames + ("le",)
+        for labels, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_labels(names, labels + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+GENERATE_LABELS = ("mode", "style", "size", "quality", "error_type")
+GENERATE_REQUESTS = Counter(
+    "illustraitor_generate_requests_total", "Запросы генерации по результату", GENERATE_LABELS
+)
+GENERATE_DURATION = Histogram(
+    "illustraitor_generate_duration_seconds", "Полное время генерации", GENERATE_LABELS
+)
+GENERATE_IN_FLIGHT = Gauge("illustraitor_generate_in_flight", "Генерации, выполняющиеся сейчас")
+GENERATE_STAGE_DURATION = Histogram(
+    "illustraitor_generate_stage_seconds",
+    "Время этапов генерации: validation, prompt_build, upstream, download, serialization",
+    ("stage",)
+)
+
+
+ADMISSION_WAIT = Histogram(
+    "illustraitor_admission_wait_seconds", "Ожидание в очереди генераций", ("priority",)
+)
+
+
+def metric_labels(request: GenerateRequest, result: dict) -> tuple:
+    """Значения меток: style, size и quality ограничены перечислениями модели запроса"""
+    return (
+        result.get("mode", "rejected"),
+        request.style,
+        request.size,
+        request.quality,
+        result.get("error_type", "none")
+    )
+
 
-# Демо изображения для разных стилей
-DEMO_IMAGES = {
-    "business": "https://images.unsplash.com/photo-1497366754035-f200968a6e72",
-    "creative": "https://images.unsplash.com/photo-1542744095-fcf48d80b0fd",
-    "fantasy": "https://images.unsplash.com/photo-1519681393784-d120267933ba",
-    "minimalist": "https://images.unsplash.com/photo-1516035069371-29a1b244cc32",
-    "cyberpunk": "https://images.unsplash.com/photo-1518709268805-4e9042af2176",
-    "watercolor": "https://images.unsplash.com/photo-1579783902614-a3fb3927b6a5",
-    "default": "https://images.unsplash.com/photo-1519681393784-d120267933ba"
-}
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
 
 # ========== КРИТИЧЕСКИ ВАЖНЫЕ ЭНДПОИНТЫ ДЛЯ RENDER ==========
 
@@ -80,9 +2356,8 @@ async def head_root():
     """
     return
 
-@app.get("/", response_class=HTMLResponse)
-async def root():
-    html_content = f"""
+def build_root_html(started_at: datetime) -> str:
+    return f"""
     <!DOCTYPE html>
     <html lang="ru">
     <head>
@@ -234,7 +2509,7 @@ async def root():
             </div>
             
             <div class="footer">
-                <p>Версия: 2.0.0 | Запущено: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
+                <p>Версия: 2.0.0 | Запущено: {started_at.strftime('%Y-%m-%d %H:%M:%S')}</p>
                 <p>Использует OpenAI DALL-E 3 API | Хостинг: Render</p>
                 <p>Status: <strong style="color: #4CAF50;">● Online</strong></p>
             </div>
@@ -242,19 +2517,17 @@ async def root():
     </body>
     </html>
     """
-    return HTMLResponse(content=html_content)
 
-@app.get("/health")
-async def health_check():
-    """
-    Health check endpoint для мониторинга Render
-    Render проверяет этот эндпоинт каждые несколько секунд
-    """
-    return JSONResponse({
+@app.get("/", response_class=HTMLResponse)
+async def root(http_request: Request):
+    return static_response("root", http_request)
+
+def build_health_body() -> dict:
+    # timestamp подставляется при каждом запросе, остальное неизменно
+    return {
         "status": "healthy",
         "service": "illustraitor-ai",
         "version": "2.0.0",
-        "timestamp": datetime.utcnow().isoformat(),
         "environment": os.getenv("ENVIRONMENT", "production"),
         "styles_count": len(STYLES),
         "uptime": "running",
@@ -265,76 +2538,232 @@ async def health_check():
             "generate": "/generate",
             "docs": "/docs"
         }
-    })
+    }
+
+@app.get("/health")
+async def health_check():
+    """
+    Health check endpoint для мониторинга Render
+    Render проверяет этот эндпоинт каждые несколько секунд
+    """
+    payloads = get_static_payloads()
+    timestamp = datetime.utcnow().isoformat().encode()
+    return Response(
+        content=payloads.health_prefix + timestamp + payloads.health_suffix,
+        media_type="application/json",
+        headers={"Cache-Control": "no-cache"}
+    )
 
 # ========== ОСНОВНЫЕ ЭНДПОИНТЫ API ==========
 
-@app.get("/styles")
-async def get_styles():
-    """Получить список всех доступных стилей генерации"""
+def style_demo_image(style: str) -> str:
+    """
+    Превью стиля для /styles. Тело собирается один раз на процесс, поэтому ссылка
+    строится от PUBLIC_BASE_URL, а без него - от корня сайта
+    """
+    if demo_renderer is not None:
+        return demo_renderer.url(style, "1024x1024")
+    return DEMO_IMAGES.get(style, DEMO_IMAGES["default"])
+
+
+def build_styles_body(built_at: datetime) -> dict:
     styles_list = []
     for key, value in STYLES.items():
         styles_list.append({
             "id": key,
             "name": value["name"],
             "description": value["prompt"],
-            "demo_image": DEMO_IMAGES.get(key, DEMO_IMAGES["default"])
+            "demo_image": style_demo_image(key)
         })
     
     return {
         "status": "success",
         "styles": styles_list, 
         "total": len(styles_list),
-        "timestamp": datetime.utcnow().isoformat(),
+        "timestamp": built_at.isoformat(),
         "note": "Для генерации используйте POST /generate"
     }
 
-@app.post("/generate")
-async def generate(request: GenerateRequest):
+@app.get("/styles")
+async def get_styles(http_request: Request):
+    """Получить список всех доступных стилей генерации"""
+    return static_response("styles", http_request)
+
+def openai_response(request: GenerateRequest, request_id: str, start_time: datetime,
+                    result: dict, prompt: str, cache_status: str,
+                    similarity: Optional[float] = None, base_url: str = "") -> dict:
+    """Ответ /generate для успешной генерации через OpenAI"""
+    image_id = result.get("image_id")
+    if image_id and (image_store is None or not image_store.has(image_id)):
+        # Запись из общего кэша другого хоста: файла здесь нет, отдаем исходную ссылку
+        image_id = None
+    if image_id:
+        image_store.touch(image_id)
+        variants = image_store.urls(image_id, base_url)
+        image_url = variants["original"]
+    else:
+        variants = None
+        image_url = result["image_url"]
+    return {
+        "status": "success",
+        "mode": "openai",
+        "image_url": image_url,
+        "source_image_url": result["image_url"],
+        "image_id": image_id,
+        "variants": variants,
+        "message": f"AI иллюстрация в стиле '{STYLES[request.style]['name']}'",
+        "style": request.style,
+        "style_name": STYLES[request.style]["name"],
+        "size": request.size,
+        "quality": request.quality,
+        "generation_time": round((datetime.now() - start_time).total_seconds(), 2),
+        "model": "dall-e-3",
+        "request_id": request_id,
+        "prompt_used": prompt[:200],
+        "cache": cache_status,
+        "similarity": similarity
+    }
+
+def new_request_id() -> str:
+    return f"req_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.urandom(4).hex()}"
+
+
+def demo_image_url(style: str, size: str, base_url: str = "") -> str:
+    if demo_renderer is not None:
+        return demo_renderer.url(style, size, base_url)
+    demo_image = DEMO_IMAGES.get(style, DEMO_IMAGES["default"])
+    width, height = size.split('x')
+    return f"{demo_image}?w={width}&h={height}&fit=crop&auto=format"
+
+
+ERROR_MESSAGES = {
+    "region_restriction": "OpenAI недоступен в вашем регионе. Используется демо-изображение.",
+    "billing_issue": "Проблема с балансом API ключа. Используется демо-изображение.",
+    "auth_error": "Неверный API ключ. Используется демо-изображение.",
+    "rate_limit": "Превышен лимит запросов. Используется демо-изображение.",
+    "timeout": "Таймаут подключения к OpenAI. Используется демо-изображение.",
+    "invalid_request": "OpenAI отклонил запрос (например, из-за политики безопасности). Используется демо-изображение.",
+    "unknown_error": "Ошибка генерации. Используется демо-изображение."
+}
+
+
+def classify_openai_error(error_msg: str) -> tuple:
+    """Определение типа ошибки OpenAI: (error_type, сообщение пользователю)"""
+    if 'Country' in error_msg or 'region' in error_msg or 'territory' in error_msg:
+        error_type = "region_restriction"
+    elif 'billing' in error_msg or 'quota' in error_msg or 'credit' in error_msg:
+        error_type = "billing_issue"
+    elif 'authentication' in error_msg or 'invalid' in error_msg or '401' in error_msg:
+        error_type = "auth_error"
+    elif 'rate' in error_msg.lower() or 'limit' in error_msg.lower():
+        error_type = "rate_limit"
+    elif 'timeout' in error_msg.lower():
+        error_type = "timeout"
+    else:
+        error_type = "unknown_error"
+    return error_type, ERROR_MESSAGES[error_type]
+
+
+def classify_error(error: Exception) -> tuple:
     """
-    Основной эндпоинт генерации изображений
-    Поддерживает два режима: демо (без ключа) и OpenAI (с API ключом)
+    Тип ошибки сначала по классу исключения (текст APITimeoutError - "Request timed out.",
+    а у 400 content_policy_violation тип invalid_request_error), затем по тексту
+    """
+    error_type = getattr(error, "error_type", None) or deterministic_error_type(error)
+    if error_type is None:
+        openai = load_openai()
+        if isinstance(error, openai.APITimeoutError):
+            error_type = "timeout"
+        elif isinstance(error, (openai.RateLimitError, UpstreamRateLimited)):
+            error_type = "rate_limit"
+        elif isinstance(error, (openai.AuthenticationError, openai.PermissionDeniedError)):
+            error_type = "auth_error"
+        elif is_request_error(error):
+            error_type = "invalid_request"
+    if error_type is None:
+        return classify_openai_error(str(error))
+    return error_type, ERROR_MESSAGES[error_type]
+
+
+async def process_generation(request: GenerateRequest, request_id: str,
+                             cache_control: Optional[str] = None, background: bool = False,
+                             base_url: str = "") -> dict:
+    """
+    Конвейер генерации одного изображения (общий для /generate, /generate/batch и /jobs)
+    Поддерживает два режима: демо (без ключа) и OpenAI (с API ключом).
+    base_url - адрес сервера для ссылок на изображения, если не задан PUBLIC_BASE_URL
+    """
+    started = time.perf_counter()
+    result = {}
+    GENERATE_IN_FLIGHT.inc()
+    try:
+        result = await run_generation(request, request_id, cache_control, background, base_url)
+        return result
+    except HTTPException:
+        # Отказ до генерации - только перегрузка (429): параметры уже проверены моделью запроса
+        result = {"mode": "rejected", "error_type": "overloaded"}
+        raise
+    finally:
+        GENERATE_IN_FLIGHT.dec()
+        duration = time.perf_counter() - started
+        labels = metric_labels(request, result)
+        GENERATE_REQUESTS.inc(*labels)
+        GENERATE_DURATION.observe(duration, *labels)
+        log_generation(request, request_id, result, duration)
+
+
+def log_generation(request: GenerateRequest, request_id: str, result: dict, duration: float):
+    """
+    Одна структурированная запись на генерацию вместо нескольких строк.
+    Успешные генерации пишутся с вероятностью LOG_SUCCESS_SAMPLE_RATE
     """
+    success = result.get("mode") in ("demo", "openai")
+    level = logging.INFO if success else logging.WARNING
+    if not logger.isEnabledFor(level):
+        return
+    if success and LOG_SUCCESS_SAMPLE_RATE < 1 and random.random() >= LOG_SUCCESS_SAMPLE_RATE:
+        return
+    fields = {
+        "event": "generate",
+        "request_id": request_id,
+        "mode": result.get("mode", "rejected"),
+        "style": request.style,
+        "size": request.size,
+        "quality": request.quality,
+        "api_key": bool(request.api_key),
+        "text_length": len(request.text),
+        "duration_ms": round(duration * 1000, 1)
+    }
+    if "cache" in result:
+        fields["cache"] = result["cache"]
+    if not success:
+        fields["error_type"] = result.get("error_type")
+        fields["error"] = result.get("original_error")
+        fields["short_circuited"] = result.get("short_circuited", False)
+    else:
+        fields["sample_rate"] = LOG_SUCCESS_SAMPLE_RATE
+    logger.log(level, "%s", LogEvent(fields))
+
+
+async def run_generation(request: GenerateRequest, request_id: str,
+                         cache_control: Optional[str] = None, background: bool = False,
+                         base_url: str = "") -> dict:
     start_time = datetime.now()
-    request_id = f"req_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.urandom(4).hex()}"
-    
-    logger.info(f"[{request_id}] === НАЧАЛО GENERATE ===")
-    logger.info(f"[{request_id}] Текст: {request.text[:50]}...")
-    logger.info(f"[{request_id}] Стиль: {request.style}")
-    logger.info(f"[{request_id}] Размер: {request.size}")
-    logger.info(f"[{request_id}] API ключ предоставлен: {bool(request.api_key)}")
-    
-    # Проверка стиля
-    if request.style not in STYLES:
-        available_styles = list(STYLES.keys())
-        logger.error(f"[{request_id}] Неверный стиль: {request.style}. Доступные: {available_styles}")
-        raise HTTPException(
-            status_code=400,
-            detail={
-                "status": "error",
-                "error": f"Неверный стиль. Доступные: {', '.join(available_styles)}",
-                "available_styles": available_styles,
-                "request_id": request_id
-            }
-        )
     
-    # Очистка proxy переменных (для избежания проблем с подключением)
-    proxy_vars = ['http_proxy', 'https_proxy', 'HTTP_PROXY', 'HTTPS_PROXY']
-    for var in proxy_vars:
-        if var in os.environ:
-            del os.environ[var]
-    os.environ['NO_PROXY'] = '*'
+    logger.debug("[%s] === НАЧАЛО GENERATE ===", request_id)
+    logger.debug("[%s] Текст: %.50s...", request_id, request.text)
+    logger.debug("[%s] Стиль: %s", request_id, request.style)
+    logger.debug("[%s] Размер: %s", request_id, request.size)
+    logger.debug("[%s] API ключ предоставлен: %s", request_id, bool(request.api_key))
     
     # Демо режим (если нет API ключа)
     if not request.api_key:
-        logger.info(f"[{request_id}] Режим: ДЕМО")
-        demo_image = DEMO_IMAGES.get(request.style, DEMO_IMAGES["default"])
-        width, height = request.size.split('x')
+        logger.debug("[%s] Режим: ДЕМО", request_id)
         
         return {
             "status": "success",
             "mode": "demo",
-            "image_url": f"{demo_image}?w={width}&h={height}&fit=crop&auto=format",
+            "image_url": demo_image_url(request.style, request.size, base_url),
             "message": f"Демо-режим: иллюстрация в стиле '{STYLES[request.style]['name']}'",
             "style": request.style,
             "style_name": STYLES[request.style]["name"],
@@ -346,73 +2775,149 @@ async def generate(request: GenerateRequest):
         }
     
     # OpenAI режим
-    logger.info(f"[{request_id}] Режим: OPENAI")
+    logger.debug("[%s] Режим: OPENAI", request_id)
     try:
-        client = OpenAI(api_key=request.api_key)
-        logger.info(f"[{request_id}] Клиент OpenAI создан успешно")
+        stage_started = time.perf_counter()
+        prompt = STYLE_PROMPT_PREFIXES[request.style] + request.text
+        GENERATE_STAGE_DURATION.observe(time.perf_counter() - stage_started, "prompt_build")
+        logger.debug("[%s] Формированный промпт: %.100s...", request_id, prompt)
         
-        prompt = f"{STYLES[request.style]['prompt']}: {request.text}"
-        logger.info(f"[{request_id}] Формированный промпт: {prompt[:100]}...")
+        # Ключ с известной детерминированной ошибкой сразу уходит в fallback
+        key_hash = hash_api_key(request.api_key)
+        upstream_guard.check_cached_error(key_hash)
+        check_validated_key(key_hash)
         
-        response = client.images.generate(
-            model="dall-e-3",
-            prompt=prompt[:4000],  # Ограничение длины промпта
-            size=request.size,
-            quality=request.quality,
-            n=1,
-            style="vivid"  # или "natural"
-        )
+        # Повторные запросы с тем же промптом отдаются из кэша без вызова DALL-E
+        cache_key = generation_cache_key(prompt, request.size, request.quality)
+        skip_lookup, no_store = cache_bypass_flags(request, cache_control)
+        cached = None if skip_lookup else await generation_cache.get(cache_key)
+        partition = (request.style, request.size, request.quality)
+        # Подпись для индекса похожих промптов считается один раз и вне цикла событий;
+        # при no-store индекс не читается и не пополняется
+        fingerprint = None if no_store else await asyncio.to_thread(prompt_fingerprint, request.text)
+        if cached is not None and await key_may_use_cache(request.api_key, key_hash):
+            logger.debug("[%s] Результат из кэша", request_id)
+            # Запись могла попасть в общий кэш из другого воркера - учим локальный индекс
+            similar_prompts.add(fingerprint, partition, cache_key)
+            return openai_response(request, request_id, start_time, cached, prompt, "hit", base_url=base_url)
         
-        image_url = response.data[0].url
-        logger.info(f"[{request_id}] OpenAI успешно: {image_url[:50]}...")
+        # Почти такой же текст (регистр, пунктуация, порядок слов) уже генерировался
+        if request.allow_similar and not skip_lookup:
+            for score, similar_key in similar_prompts.find(fingerprint, partition):
+                cached = await generation_cache.get(similar_key)
+                if cached is None:
+                    similar_prompts.remove(similar_key)  # Запись кэша истекла
+                    continue
+                if not await key_may_use_cache(request.api_key, key_hash):
+                    break
+                similar_prompts.hits += 1
+                logger.debug("[%s] Похожий промпт в кэше, сходство %.2f", request_id, score)
+                return openai_response(
+                    request, request_id, start_time, cached, prompt, "similar", round(score, 3), base_url
+                )
         
-        return {
-            "status": "success",
-            "mode": "openai",
-            "image_url": image_url,
-            "message": f"AI иллюстрация в стиле '{STYLES[request.style]['name']}'",
-            "style": request.style,
-            "style_name": STYLES[request.style]["name"],
-            "size": request.size,
-            "quality": request.quality,
-            "generation_time": round((datetime.now() - start_time).total_seconds(), 2),
-            "model": "dall-e-3",
-            "request_id": request_id,
-            "prompt_used": prompt[:200]
-        }
+        async def call_upstream() -> str:
+            # Асинхронный клиент: ожидание DALL-E (10-30 с) не блокирует event loop,
+            # поэтому /health и другие запросы обслуживаются параллельно
+            probes = upstream_guard.before_call(key_hash)
+            try:
+                response = await call_images_api(
+                    request.api_key,
+                    rate_reserved=True,
+                    model="dall-e-3",
+                    prompt=prompt,  # Длина ограничена TEXT_MAX_LENGTH при валидации
+                    size=request.size,
+                    quality=request.quality,
+                    n=1,
+                    style="vivid"  # или "natural"
+                )
+            except UpstreamRateLimited:
+                raise  # Локальный лимит - не сбой upstream
+            except Exception as e:
+                upstream_guard.record(key_hash, e)
+                raise
+            else:
+                upstream_guard.record(key_hash, None)
+                verified_keys.set(key_hash, {"valid": True})
+            finally:
+                upstream_guard.release_probes(probes)
+            result = {"image_url": response.data[0].url}
+            if image_store is not None:
+                stage_started = time.perf_counter()
+                try:
+                    result["image_id"] = await image_store.materialize(result["image_url"])
+                except Exception as e:
+                    # Без локальной копии клиент получит исходную ссылку OpenAI
+                    logger.warning("[%s] Не удалось сохранить изображение: %s", request_id, e)
+                finally:
+                    GENERATE_STAGE_DURATION.observe(time.perf_counter() - stage_started, "download")
+            if not no_store:
+                await generation_cache.set(cache_key, result)
+                similar_prompts.add(fingerprint, partition, cache_key)
+            return result
+
+        async def call_admitted() -> dict:
+            # Очередь с приоритетами ждет только тот, кто действительно вызывает DALL-E
+            priority = generation_priority(request, key_hash, background)
+            # Токен лимита ключа ждем до очереди, а не занимая слот допуска
+            await image_rate_limiter.acquire(key_hash, time.monotonic() + OPENAI_RETRY_DEADLINE)
+            try:
+                waited = await generation_scheduler.acquire(priority)
+            except BaseException:
+                image_rate_limiter.refund(key_hash)
+                raise
+            ADMISSION_WAIT.observe(waited, priority)
+            admitted = time.monotonic()
+            try:
+                return await call_upstream()
+            finally:
+                generation_scheduler.release(time.monotonic() - admitted)
+
+        async def call_across_workers() -> dict:
+            # Без записи в кэш другие воркеры не увидят результат - ждать нечего
+            if no_store:
+                return await call_admitted()
+            result, shared = await shared_flight.do(cache_key, call_admitted)
+            if shared:
+                if not await key_may_use_cache(request.api_key, key_hash):
+                    return await call_admitted()
+                logger.debug("[%s] Результат получен от генерации в другом воркере", request_id)
+            return result
+
+        # Одинаковые запросы, пришедшие во время генерации, ждут тот же вызов
+        result, coalesced = await generation_flight.do(cache_key, key_hash, call_across_workers)
+        if coalesced and not await key_may_use_cache(request.api_key, key_hash):
+            result, coalesced = await call_admitted(), False
+        if coalesced:
+            logger.debug("[%s] Присоединен к уже выполняющейся генерации", request_id)
+        logger.debug("[%s] OpenAI успешно: %.50s...", request_id, result["image_url"])
+        
+        return openai_response(request, request_id, start_time, result, prompt, "miss", base_url=base_url)
         
+    except AdmissionRejected as e:
+        # Перегрузка: быстрый отказ вместо fallback, клиент повторит позже
+        logger.debug("[%s] Отказ в допуске: %s", request_id, e)
+        raise HTTPException(
+            status_code=429,
+            detail={
+                "status": "error",
+                "error": str(e),
+                "retry_after": e.retry_after,
+                "request_id": request_id
+            },
+            headers={"Retry-After": str(e.retry_after)}
+        )
     except Exception as e:
         error_msg = str(e)
-        logger.error(f"[{request_id}] Ошибка OpenAI: {error_msg}")
+        logger.debug("[%s] Ошибка OpenAI: %s", request_id, error_msg)
         
         # Автоматический fallback на демо-режим при ошибке
-        demo_image = DEMO_IMAGES.get(request.style, DEMO_IMAGES["default"])
-        width, height = request.size.split('x')
-        
-        # Определяем тип ошибки
-        error_type = "unknown_error"
-        user_message = "Ошибка генерации. Используется демо-изображение."
-        
-        if 'Country' in error_msg or 'region' in error_msg or 'territory' in error_msg:
-            error_type = "region_restriction"
-            user_message = "OpenAI недоступен в вашем регионе. Используется демо-изображение."
-        elif 'billing' in error_msg or 'quota' in error_msg or 'credit' in error_msg:
-            error_type = "billing_issue"
-            user_message = "Проблема с балансом API ключа. Используется демо-изображение."
-        elif 'authentication' in error_msg or 'invalid' in error_msg or '401' in error_msg:
-            error_type = "auth_error"
-            user_message = "Неверный API ключ. Используется демо-изображение."
-        elif 'rate' in error_msg.lower() or 'limit' in error_msg.lower():
-            error_type = "rate_limit"
-            user_message = "Превышен лимит запросов. Используется демо-изображение."
-        elif 'timeout' in error_msg.lower():
-            error_type = "timeout"
-            user_message = "Таймаут подключения к OpenAI. Используется демо-изображение."
+        error_type, user_message = classify_error(e)
         
         return {
             "status": "success",  # Успех, потому что вернули fallback
             "mode": "fallback",
-            "image_url": f"{demo_image}?w={width}&h={height}&fit=crop&auto=format",
+            "image_url": demo_image_url(request.style, request.size, base_url),
             "message": user_message,
             "error_type": error_type,
             "original_error": error_msg[:200] if len(error_msg) > 200 else error_msg,
@@ -420,42 +2925,495 @@ async def generate(request: GenerateRequest):
             "style_name": STYLES[request.style]["name"],
             "generation_time": round((datetime.now() - start_time).total_seconds(), 2),
             "recovery_strategy": "fallback_to_demo",
+            "short_circuited": isinstance(e, UpstreamShortCircuit),
             "request_id": request_id,
             "suggestion": "Проверьте API ключ или попробуйте позже"
         }
 
+@app.post("/generate")
+async def generate(request: GenerateRequest, http_request: Request,
+                   cache_control: Optional[str] = Header(None)):
+    """
+    Основной эндпоинт генерации изображений
+    Поддерживает два режима: демо (без ключа) и OpenAI (с API ключом)
+    """
+    result = await process_generation(request, new_request_id(), cache_control,
+                                      base_url=request_base_url(http_request))
+    # Сериализация выполняется явно, чтобы ее время попало в метрики
+    stage_started = time.perf_counter()
+    body = dumps_json(result)
+    GENERATE_STAGE_DURATION.observe(time.perf_counter() - stage_started, "serialization")
+    return Response(content=body, media_type="application/json")
+
+@app.post("/generate/batch")
+async def generate_batch(batch: BatchGenerateRequest, http_request: Request,
+                         cache_control: Optional[str] = Header(None)):
+    """
+    Пакетная генерация: элементы обрабатываются параллельно (с ограничением)
+    и отдаются потоком NDJSON или SSE по мере готовности.
+    Ошибка одного элемента не прерывает пакет.
+    """
+    batch_id = new_request_id().replace("req_", "batch_", 1)
+    base_url = request_base_url(http_request)
+    concurrency = max(1, min(batch.concurrency or BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY))
+    logger.info("[%s] Пакет: %s элементов, параллельно: %s", batch_id, len(batch.items), concurrency)
+    
+    async def run_item(index: int, raw_item: Any, semaphore: asyncio.Semaphore) -> dict:
+        item_id = f"{batch_id}_{index}"
+        try:
+            item = GenerateRequest.model_validate(raw_item)
+        except ValidationError as e:
+            return {"batch_id": batch_id, "index": index, "status": "error",
+                    "error": "Некорректные параметры элемента",
+                    "details": e.errors(include_url=False, include_context=False), "request_id": item_id}
+        async with semaphore:
+            try:
+                result = await process_generation(item, item_id, cache_control, base_url=base_url)
+            except HTTPException as e:
+                result = e.detail
+            except Exception as e:
+                logger.error("[%s] Ошибка элемента пакета: %s", item_id, e)
+                result = {"status": "error", "error": str(e), "request_id": item_id}
+        return {"batch_id": batch_id, "index": index, **result}
+    
+    async def stream():
+        semaphore = asyncio.Semaphore(concurrency)
+        tasks = [asyncio.create_task(run_item(i, item, semaphore)) for i, item in enumerate(batch.items)]
+        counts = {}
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                mode = result.get("mode", result["status"])
+                counts[mode] = counts.get(mode, 0) + 1
+                yield encode_batch_event("result", result, batch.format)
+            yield encode_batch_event("done", {
+                "batch_id": batch_id,
+                "status": "done",
+                "total": len(tasks),
+                "modes": counts
+            }, batch.format)
+        finally:
+            # Клиент отключился - незавершенные генерации больше не нужны
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(
+        stream(),
+        media_type=BATCH_FORMATS[batch.format],
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# ========== АСИНХРОННЫЕ ЗАДАЧИ (JOBS) ==========
+
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "jobs.db")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+# Сколько хранить завершенные задачи (секунды)
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", "86400"))
+JOB_PURGE_INTERVAL = 3600
+# Задача в статусе running без продления дольше этого срока считается брошенной
+# (процесс упал или перезапущен) и возвращается в очередь
+JOB_LEASE = float(os.getenv("JOB_LEASE", "180"))
+# Выполняющаяся задача продлевает аренду (ожидание в очереди допуска может быть долгим)
+JOB_HEARTBEAT_INTERVAL = JOB_LEASE / 3
+
+
+class JobStore:
+    """
+    Хранилище задач генерации в SQLite: очередь переживает перезапуск.
+    Все обращения к базе выполняются в потоке, чтобы не блокировать event loop.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY,"
+                " status TEXT NOT NULL,"
+                " request TEXT NOT NULL,"
+                " result TEXT,"
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL,"
+                " base_url TEXT NOT NULL DEFAULT '')"
+            )
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            if "base_url" not in columns:
+                # База, созданная предыдущей версией
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN base_url TEXT NOT NULL DEFAULT ''")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+
+    def _execute(self, sql: str, params: tuple = ()) -> list:
+        with self._lock, self._conn:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _update(self, sql: str, params: tuple = ()) -> int:
+        with self._lock, self._conn:
+            return self._conn.execute(sql, params).rowcount
+
+    async def create(self, job_id: str, request: GenerateRequest, base_url: str = ""):
+        # base_url - адрес, на который пришел запрос: от него строятся ссылки в результате
+        now = time.time()
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT INTO jobs (id, status, request, created_at, updated_at, base_url)"
+            " VALUES (?, 'queued', ?, ?, ?, ?)",
+            (job_id, request.model_dump_json(), now, now, base_url)
+        )
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        rows = await asyncio.to_thread(
+            self._execute,
+            "SELECT id, status, request, result, created_at, updated_at, base_url FROM jobs WHERE id = ?",
+            (job_id,)
+        )
+        if not rows:
+            return None
+        job_id, status, request_json, result_json, created_at, updated_at, base_url = rows[0]
+        return {
+            "job_id": job_id,
+            "status": status,
+            "request": request_json,
+            "result": json.loads(result_json) if result_json else None,
+            "created_at": created_at,
+            "updated_at": updated_at,
+            "base_url": base_url
+        }
+
+    async def claim(self, job_id: str) -> bool:
+        """
+        Захват задачи воркером. Условное обновление атомарно, поэтому
+        из нескольких процессов с общей базой задачу получит только один
+        """
+        updated = await asyncio.to_thread(
+            self._update,
+            "UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ? AND status = 'queued'",
+            (time.time(), job_id)
+        )
+        return updated == 1
+
+    async def heartbeat(self, job_id: str):
+        """Продление аренды выполняющейся задачи"""
+        await asyncio.to_thread(
+            self._update,
+            "UPDATE jobs SET updated_at = ? WHERE id = ? AND status = 'running'",
+            (time.time(), job_id)
+        )
+
+    async def finish(self, job_id: str, status: str, result: dict, request: GenerateRequest):
+        # API ключ нужен только до завершения задачи - после убираем его из базы
+        request_json = request.model_copy(update={"api_key": None}).model_dump_json()
+        await asyncio.to_thread(
+            self._execute,
+            "UPDATE jobs SET status = ?, result = ?, request = ?, updated_at = ? WHERE id = ?",
+            (status, json.dumps(result, ensure_ascii=False), request_json, time.time(), job_id)
+        )
+
+    async def reject(self, job_id: str, result: dict):
+        """Завершение задачи с ошибкой без выполнения (сохраненный запрос не проходит проверку)"""
+        await asyncio.to_thread(
+            self._execute,
+            "UPDATE jobs SET status = 'error', result = ?, request = '{}', updated_at = ?"
+            " WHERE id = ? AND status = 'queued'",
+            (json.dumps(result, ensure_ascii=False, default=str), time.time(), job_id)
+        )
+
+    async def pending(self) -> list:
+        """Задачи, ожидающие выполнения, в порядке поступления"""
+        rows = await asyncio.to_thread(
+            self._execute,
+            "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at"
+        )
+        return [row[0] for row in rows]
+
+    async def requeue_stale(self, older_than: float) -> list:
+        """Возврат в очередь задач, брошенных упавшим или перезапущенным процессом"""
+        rows = await asyncio.to_thread(
+            self._execute,
+            "SELECT id FROM jobs WHERE status = 'running' AND updated_at < ? ORDER BY created_at",
+            (older_than,)
+        )
+        requeued = []
+        for (job_id,) in rows:
+            updated = await asyncio.to_thread(
+                self._update,
+                "UPDATE jobs SET status = 'queued', updated_at = ?"
+                " WHERE id = ? AND status = 'running' AND updated_at < ?",
+                (time.time(), job_id, older_than)
+            )
+            if updated == 1:
+                requeued.append(job_id)
+        return requeued
+
+    async def purge(self, older_than: float):
+        await asyncio.to_thread(
+            self._execute,
+            "DELETE FROM jobs WHERE status IN ('done', 'error') AND updated_at < ?",
+            (older_than,)
+        )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class JobRunner:
+    """Пул асинхронных воркеров, обрабатывающих очередь задач"""
+
+    def __init__(self, store: JobStore, workers: int):
+        self.store = store
+        self.workers = workers
+        self.queue: Optional[asyncio.Queue] = None
+        self._tasks = []
+        self._last_purge = 0.0
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        await self.store.purge(time.time() - JOB_RESULT_TTL)
+        self._last_purge = time.time()
+        await self.store.requeue_stale(time.time() - JOB_LEASE)
+        # При нескольких процессах задача попадет во все очереди,
+        # но выполнит ее только воркер, успевший захватить ее в базе
+        for job_id in await self.store.pending():
+            self.queue.put_nowait(job_id)
+        if self.queue.qsize():
+            logger.info("Восстановлено задач из очереди: %s", self.queue.qsize())
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._recover_stale()))
+
+    async def stop(self):
+        # Незавершенные задачи остаются в базе и будут продолжены после перезапуска
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, job_id: str, request: GenerateRequest, base_url: str = ""):
+        await self.store.create(job_id, request, base_url)
+        self.queue.put_nowait(job_id)
+
+    async def _worker(self):
+        while True:
+            job_id = await self.queue.get()
+            try:
+                await self._run(job_id)
+            except Exception as e:
+                logger.error("[%s] Ошибка обработки задачи: %s", job_id, e)
+            finally:
+                self.queue.task_done()
+
+    async def _recover_stale(self):
+        while True:
+            await asyncio.sleep(JOB_LEASE)
+            try:
+                for job_id in await self.store.requeue_stale(time.time() - JOB_LEASE):
+                    logger.warning("[%s] Задача не завершена вовремя, возвращена в очередь", job_id)
+                    self.queue.put_nowait(job_id)
+            except Exception as e:
+                logger.error("Ошибка восстановления задач: %s", e)
+
+    async def _heartbeat(self, job_id: str):
+        # Без продления задача, долго ждущая в очереди допуска, вернулась бы
+        # в очередь и выполнилась бы второй раз
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+            try:
+                await self.store.heartbeat(job_id)
+            except Exception as e:
+                logger.error("[%s] Не удалось продлить аренду задачи: %s", job_id, e)
+
+    async def _run(self, job_id: str):
+        job = await self.store.get(job_id)
+        if job is None or job["status"] != "queued":
+            return
+        try:
+            request = GenerateRequest.model_validate_json(job["request"])
+        except ValidationError as e:
+            # Задача из старой версии с параметрами, которые теперь недопустимы
+            await self.store.reject(job_id, {
+                "status": "error", "error": "Некорректные параметры задачи",
+                "details": e.errors(include_url=False, include_context=False), "request_id": job_id
+            })
+            return
+        if not await self.store.claim(job_id):
+            return  # Задачу уже взял другой процесс
+
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            result = await process_generation(request, job_id, background=True, base_url=job["base_url"])
+            status = "done"
+        except HTTPException as e:
+            result = e.detail
+            status = "error"
+        except Exception as e:
+            result = {"status": "error", "error": str(e), "request_id": job_id}
+            status = "error"
+        finally:
+            heartbeat.cancel()
+        await self.store.finish(job_id, status, result, request)
+
+        if time.time() - self._last_purge > JOB_PURGE_INTERVAL:
+            self._last_purge = time.time()
+            await self.store.purge(self._last_purge - JOB_RESULT_TTL)
+
+
+job_runner: Optional[JobRunner] = None
+
+
+@app.on_event("startup")
+async def start_job_runner():
+    global job_runner
+    store = await asyncio.to_thread(JobStore, JOBS_DB_PATH)
+    job_runner = JobRunner(store, JOB_WORKERS)
+    await job_runner.start()
+
+
+@app.on_event("shutdown")
+async def stop_job_runner():
+    if job_runner is not None:
+        await job_runner.stop()
+        job_runner.store.close()
+
+
+def job_status_response(job: dict) -> dict:
+    return {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "result": job["result"],
+        "created_at": datetime.utcfromtimestamp(job["created_at"]).isoformat(),
+        "updated_at": datetime.utcfromtimestamp(job["updated_at"]).isoformat(),
+        "poll_url": f"/jobs/{job['job_id']}"
+    }
+
+@app.post("/jobs", status_code=202)
+async def create_job(request: GenerateRequest, http_request: Request):
+    """
+    Постановка генерации в очередь. Сразу возвращает job_id,
+    результат забирается через GET /jobs/{job_id}
+    """
+    job_id = new_request_id()
+    await job_runner.submit(job_id, request, request_base_url(http_request))
+    logger.info("[%s] Задача поставлена в очередь", job_id)
+    return {
+        "job_id": job_id,
+        "request_id": job_id,
+        "status": "queued",
+        "poll_url": f"/jobs/{job_id}",
+        "queue_size": job_runner.queue.qsize()
+    }
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    Статус задачи: queued, running, done или error.
+    Поле result имеет тот же формат, что и ответ POST /generate
+    """
+    job = await job_runner.store.get(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=404,
+            detail={"status": "error", "error": "Задача не найдена", "job_id": job_id}
+        )
+    return job_status_response(job)
+
+# ========== РАЗДАЧА ДЕМО-ЗАГЛУШЕК ==========
+
+@app.get("/demo/{style}/{variant}")
+async def get_demo_image(style: str, variant: str, http_request: Request):
+    """Локальная демо-заглушка, например /demo/fantasy/1024x1024.webp"""
+    size, _, ext = variant.partition(".")
+    if demo_renderer is None or ext != "webp" or size not in DEMO_SIZES \
+            or (style not in STYLES and style != "default"):
+        raise HTTPException(status_code=404, detail={"status": "error", "error": "Заглушка не найдена"})
+
+    data, etag = demo_renderer.get_cached(style, size) or await demo_renderer.get(style, size)
+    headers = {"ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL}
+    if etag in http_request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(content=data, media_type="image/webp", headers=headers)
+
+# ========== РАЗДАЧА ИЗОБРАЖЕНИЙ ==========
+
+def stored_image_id(image_id: str) -> str:
+    if image_store is None or not ImageStore.is_valid_id(image_id):
+        raise HTTPException(status_code=404, detail={"status": "error", "error": "Изображение не найдено"})
+    return image_id
+
+@app.get("/images/{image_id}")
+async def get_image(image_id: str, http_request: Request):
+    """Оригинал сгенерированного изображения (PNG)"""
+    stored_image_id(image_id)
+    image_store.touch(image_id)
+    return await send_stored_file(
+        image_store.original_path(image_id), "image/png", f'"{image_id}"', http_request
+    )
+
+@app.get("/images/{image_id}/{variant}")
+async def get_image_variant(image_id: str, variant: str, http_request: Request):
+    """
+    Уменьшенная копия изображения, например /images/{image_id}/512.webp
+    Доступные ширины: 256, 512, 1024; форматы: webp, jpg
+    """
+    stored_image_id(image_id)
+    width_text, _, ext = variant.partition(".")
+    if ext not in IMAGE_VARIANT_FORMATS or not width_text.isdigit() or int(width_text) not in IMAGE_VARIANT_WIDTHS:
+        raise HTTPException(
+            status_code=404,
+            detail={
+                "status": "error",
+                "error": "Неизвестный вариант изображения",
+                "widths": list(IMAGE_VARIANT_WIDTHS),
+                "formats": list(IMAGE_VARIANT_FORMATS)
+            }
+        )
+    if not os.path.exists(image_store.original_path(image_id)):
+        raise HTTPException(status_code=404, detail={"status": "error", "error": "Изображение не найдено"})
+
+    width = int(width_text)
+    image_store.touch(image_id)
+    path = await image_store.ensure_variant(image_id, width, ext)
+    return await send_stored_file(
+        path, IMAGE_VARIANT_FORMATS[ext][1], f'"{image_id}-{width}-{ext}"', http_request
+    )
+
 @app.get("/test-openai")
 async def test_openai(api_key: str):
     """
     Проверка работоспособности OpenAI API ключа
     Использование: GET /test-openai?api_key=sk-...
+    Результат кэшируется на KEY_VALIDATION_TTL секунд
     """
     try:
-        client = OpenAI(api_key=api_key)
-        models = client.models.list()
-        
-        # Проверяем доступность DALL-E
-        dall_e_available = any('dall' in model.id.lower() for model in models.data)
-        
+        validation, cached = await validate_api_key(api_key)
+    except Exception as e:
+        # Транзиентная ошибка проверки (таймаут, 5xx) - не кэшируется
         return {
-            "status": "success",
-            "message": "OpenAI API ключ работает",
-            "models_count": len(models.data),
-            "dall_e_available": dall_e_available,
-            "organization": getattr(client, 'organization', 'not_set'),
+            "status": "error",
+            "error": str(e),
+            "message": "Не удалось проверить OpenAI API ключ",
             "timestamp": datetime.utcnow().isoformat()
         }
-    except Exception as e:
+    
+    if not validation["valid"]:
         return {
             "status": "error",
-            "error": str(e),
+            "error": validation["error"],
             "message": "OpenAI API ключ не работает",
+            "cached": cached,
             "timestamp": datetime.utcnow().isoformat()
         }
+    return {
+        "status": "success",
+        "message": "OpenAI API ключ работает",
+        "dall_e_available": validation["dall_e_available"],
+        "organization": validation["organization"],
+        "cached": cached,
+        "timestamp": datetime.utcnow().isoformat()
+    }
 
-@app.get("/info")
-async def get_info():
-    """Информация о сервере и доступных функциях"""
+def build_info_body(built_at: datetime) -> dict:
     return {
         "service": "Illustraitor AI",
         "version": "2.0.0",
@@ -463,9 +3421,12 @@ async def get_info():
         "features": {
             "styles_count": len(STYLES),
             "modes": ["demo", "openai", "fallback"],
-            "demo_images": "Unsplash",
+            "demo_images": "local" if demo_renderer is not None else "Unsplash",
             "ai_model": "OpenAI DALL-E 3",
-            "max_prompt_length": 4000
+            "max_prompt_length": DALLE_PROMPT_MAX_LENGTH,
+            "max_text_length": TEXT_MAX_LENGTH,
+            "sizes": list(IMAGE_SIZES),
+            "qualities": list(IMAGE_QUALITIES)
         },
         "endpoints": {
             "GET /": "Главная страница",
@@ -476,12 +3437,141 @@ async def get_info():
             "GET /docs": "Swagger документация",
             "GET /redoc": "ReDoc документация"
         },
-        "timestamp": datetime.utcnow().isoformat(),
+        "timestamp": built_at.isoformat(),
         "status": "operational"
     }
 
+@app.get("/info")
+async def get_info(http_request: Request):
+    """Информация о сервере и доступных функциях"""
+    return static_response("info", http_request)
+
+@app.get("/stats")
+async def get_stats():
+    """Счетчики конвейера генерации для мониторинга"""
+    return {
+        "generation_cache": {
+            "entries": len(generation_cache),
+            "hits": generation_cache.hits,
+            "misses": generation_cache.misses
+        },
+        "single_flight": {
+            "in_flight": generation_flight.in_flight,
+            "coalesced": generation_flight.coalesced,
+            "coalesced_across_workers": shared_flight.coalesced
+        },
+        "admission": generation_scheduler.snapshot(),
+        "startup": startup_milestones,
+        "similar_prompts": {
+            "entries": len(similar_prompts),
+            "hits": similar_prompts.hits,
+            "threshold": similar_prompts.threshold
+        },
+        "state_backend": STATE_BACKEND if _state_backend is None else _state_backend.name,
+        "worker_pid": os.getpid(),
+        "upstream": {
+            "concurrency_limit": int(upstream_concurrency.limit),
+            "in_flight": upstream_concurrency.in_flight,
+            "retries": upstream_retries
+        },
+        "circuit_breakers": upstream_guard.snapshot(),
+        "validated_keys": len(key_validation_cache),
+        "openai_clients": len(openai_clients),
+        "timestamp": datetime.utcnow().isoformat()
+    }
+
+BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+METRICS = [
+    GENERATE_REQUESTS,
+    GENERATE_DURATION,
+    GENERATE_IN_FLIGHT,
+    GENERATE_STAGE_DURATION,
+    Counter("illustraitor_generation_cache_hits_total", "Попадания в кэш генераций",
+          collect=lambda: generation_cache.hits),
+    Counter("illustraitor_generation_cache_misses_total", "Промахи кэша генераций",
+          collect=lambda: generation_cache.misses),
+    Gauge("illustraitor_generation_cache_entries", "Записей в кэше генераций",
+          collect=lambda: len(generation_cache)),
+    Counter("illustraitor_similar_prompt_hits_total", "Ответы готовым изображением для похожего текста",
+          collect=lambda: similar_prompts.hits),
+    Counter("illustraitor_coalesced_requests_total", "Запросы, присоединенные к идущей генерации",
+          collect=lambda: generation_flight.coalesced),
+    Counter("illustraitor_coalesced_across_workers_total",
+          "Запросы, получившие результат генерации другого воркера",
+          collect=lambda: shared_flight.coalesced),
+    Counter("illustraitor_upstream_retries_total", "Повторные вызовы DALL-E",
+          collect=lambda: upstream_retries),
+    Gauge("illustraitor_upstream_concurrency_limit", "Текущий адаптивный лимит вызовов DALL-E",
+          collect=lambda: int(upstream_concurrency.limit)),
+    Gauge("illustraitor_upstream_in_flight", "Вызовы DALL-E, выполняющиеся сейчас",
+          collect=lambda: upstream_concurrency.in_flight),
+    Counter("illustraitor_short_circuited_total", "Запросы, отправленные в fallback без вызова OpenAI",
+          collect=lambda: upstream_guard.short_circuited),
+    Gauge("illustraitor_global_breaker_state", "Общий circuit breaker: 0 closed, 1 half_open, 2 open",
+          collect=lambda: BREAKER_STATES[upstream_guard.global_breaker.state]),
+    ADMISSION_WAIT,
+    Gauge("illustraitor_admission_queue_depth", "Генерации, ожидающие в очереди допуска", ("priority",),
+          collect=lambda: {(name,): value for name, value in generation_scheduler.waiting.items()}),
+    Gauge("illustraitor_admission_active", "Генерации, допущенные к вызову DALL-E",
+          collect=lambda: generation_scheduler.active),
+    Counter("illustraitor_admission_rejected_total", "Отказы в допуске (429)", ("priority",),
+          collect=lambda: {(name,): value for name, value in generation_scheduler.rejected.items()}),
+    Gauge("illustraitor_generation_service_seconds", "Скользящая оценка времени генерации",
+          collect=lambda: generation_scheduler.service_time),
+    Gauge("illustraitor_job_queue_size", "Задачи в очереди",
+          collect=lambda: job_runner.queue.qsize() if job_runner is not None and job_runner.queue else 0),
+    Gauge("illustraitor_startup_seconds", "Вехи холодного старта от начала импорта main", ("milestone",),
+          collect=lambda: {(name,): value for name, value in startup_milestones.items()}),
+]
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Метрики в текстовом формате Prometheus"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+# ========== ХОЛОДНЫЙ СТАРТ ==========
+
+# Импорт SDK OpenAI в фоне, чтобы первый запрос с ключом не ждал его
+OPENAI_WARMUP = os.getenv("OPENAI_WARMUP", "1") == "1"
+# uvicorn открывает порт после обработчиков startup, поэтому прогрев чуть откладывается
+OPENAI_WARMUP_DELAY = float(os.getenv("OPENAI_WARMUP_DELAY", "1"))
+
+
+async def warm_up_openai():
+    await asyncio.sleep(OPENAI_WARMUP_DELAY)
+    try:
+        await asyncio.to_thread(load_openai)
+        get_upstream_http_client()
+        mark_startup("warmup_done")
+    except Exception as e:
+        logger.warning("Не удалось прогреть SDK OpenAI: %s", e)
+
+
+@app.on_event("startup")
+async def report_startup():
+    """Последний обработчик startup: дальше uvicorn начинает принимать соединения"""
+    mark_startup("app_ready")
+    logger.info(
+        "Холодный старт: импорты %.3f с, модуль %.3f с, приложение готово %.3f с",
+        startup_milestones["imports"], startup_milestones["module_loaded"], startup_milestones["app_ready"]
+    )
+    if OPENAI_WARMUP and _openai is None:
+        app.state.openai_warmup = asyncio.create_task(warm_up_openai())
+
+
+mark_startup("module_loaded")
+
 # ========== СТАРТ СЕРВЕРА ==========
 if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] == ["render-demo"]:
+        # Отрисовка заглушек при сборке (build command), чтобы старт сервера их только читал
+        if demo_renderer is not None:
+            demo_renderer.render_all()
+        sys.exit(0)
+
     import uvicorn
     
     # Получаем порт из переменных окружения (Render передает через $PORT)
@@ -489,16 +3579,33 @@ if __name__ == "__main__":
     
     logger.info("=" * 50)
     logger.info("🚀 Запуск Illustraitor AI API")
-    logger.info(f"📌 Порт: {port}")
-    logger.info(f"🎨 Стилей: {len(STYLES)}")
-    logger.info(f"📚 Документация: http://localhost:{port}/docs")
-    logger.info(f"🩺 Health check: http://localhost:{port}/health")
+    logger.info("📌 Порт: %s", port)
+    logger.info("🎨 Стилей: %s", len(STYLES))
+    logger.info("📚 Документация: http://localhost:%s/docs", port)
+    logger.info("🩺 Health check: http://localhost:%s/health", port)
+    
+    # Несколько процессов на одном хосте: общий кэш и блокировки генераций
+    # хранятся в STATE_BACKEND, поэтому воркеры не дублируют вызовы DALL-E
+    workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+    # uvloop и httptools ускоряют event loop и разбор HTTP, если установлены
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    http = "httptools" if importlib.util.find_spec("httptools") else "h11"
+    logger.info("👷 Воркеров: %s (loop=%s, http=%s, состояние=%s)", workers, loop, http, STATE_BACKEND)
+    if workers > 1 and STATE_BACKEND == "memory":
+        logger.warning("STATE_BACKEND=memory не разделяется между воркерами")
+    if workers > 1 and demo_renderer is not None:
+        # Один раз до запуска воркеров: иначе каждый воркер рисовал бы тот же набор
+        demo_renderer.render_all()
     logger.info("=" * 50)
     
     uvicorn.run(
-        app,
+        # Для нескольких воркеров uvicorn нужна строка импорта приложения
+        "main:app" if workers > 1 else app,
         host="0.0.0.0",  # Доступ с любого IP
         port=port,
+        workers=workers,
+        loop=loop,
+        http=http,
         log_level="info",
         access_log=True,
         timeout_keep_alive=5
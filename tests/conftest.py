@@ -0,0 +1,25 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Окружение задается до импорта main: настройки читаются при импорте модуля
+_state_dir = tempfile.mkdtemp(prefix="illustraitor-tests-")
+os.environ.update({
+    "STATE_BACKEND": "memory",
+    "STATE_DB_PATH": os.path.join(_state_dir, "state.db"),
+    "JOBS_DB_PATH": os.path.join(_state_dir, "jobs.db"),
+    "IMAGE_STORE_DIR": os.path.join(_state_dir, "image_store"),
+    "DEMO_RENDERER": "remote",
+    "OPENAI_WARMUP": "0",
+    "LOG_LEVEL": "WARNING",
+})
+os.environ.pop("PUBLIC_BASE_URL", None)
+os.environ.pop("RENDER_EXTERNAL_URL", None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
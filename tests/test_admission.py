@@ -0,0 +1,139 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+
+
+def scheduler(limit: int = 1, max_queue: int = 10, queue_timeout: float = 5.0) -> main.GenerationScheduler:
+    concurrency = main.AdaptiveConcurrencyLimiter(1, 8, limit, latency_target=10)
+    return main.GenerationScheduler(concurrency, 0, max_queue, queue_timeout, service_time=2.0)
+
+
+async def enqueue(admission: main.GenerationScheduler, priority: str, order: list) -> asyncio.Task:
+    async def wait():
+        await admission.acquire(priority)
+        order.append(priority)
+
+    task = asyncio.create_task(wait())
+    await asyncio.sleep(0)
+    return task
+
+
+@pytest.mark.anyio
+async def test_waiters_are_admitted_by_priority():
+    admission = scheduler()
+    await admission.acquire("normal")
+    order = []
+    tasks = [await enqueue(admission, priority, order) for priority in ("background", "normal", "high")]
+    assert admission.queue_depth == 3
+
+    for _ in tasks:
+        admission.release(1.0)
+        await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+
+    assert order == ["high", "normal", "background"]
+    assert admission.active == 1
+
+
+@pytest.mark.anyio
+async def test_full_queue_is_rejected_with_retry_after():
+    admission = scheduler(max_queue=2)  # Обычным запросам доступно int(2 * 0.8) = 1 место
+    await admission.acquire("normal")
+    order = []
+    waiting = await enqueue(admission, "normal", order)
+
+    with pytest.raises(main.AdmissionRejected) as error:
+        await admission.acquire("normal")
+    # (глубина очереди + 1) * время обслуживания / лимит = 2 * 2.0 / 1
+    assert error.value.retry_after == 4
+    high = await enqueue(admission, "high", order)  # Запас очереди остается за high
+    assert admission.rejected == {"high": 0, "normal": 1, "background": 0}
+
+    for task in (waiting, high):
+        task.cancel()
+    await asyncio.gather(waiting, high, return_exceptions=True)
+
+
+@pytest.mark.anyio
+async def test_interactive_wait_times_out_but_background_waits():
+    admission = scheduler(queue_timeout=0.05)
+    await admission.acquire("normal")
+    order = []
+    background = await enqueue(admission, "background", order)
+
+    with pytest.raises(main.AdmissionRejected):
+        await admission.acquire("normal")
+    assert not background.done()
+
+    admission.release(1.0)
+    await asyncio.wait_for(background, 1)
+    assert order == ["background"]
+
+
+@pytest.mark.anyio
+async def test_slot_handed_to_cancelled_waiter_moves_on():
+    admission = scheduler()
+    await admission.acquire("normal")
+    order = []
+    first = await enqueue(admission, "normal", order)
+    second = await enqueue(admission, "normal", order)
+
+    admission.release(1.0)  # Слот передан first, но он отменяется до продолжения
+    first.cancel()
+    await asyncio.gather(first, return_exceptions=True)
+    await asyncio.wait_for(second, 1)
+
+    assert order == ["normal"]
+    assert admission.active == 1 and admission.queue_depth == 0
+
+
+@pytest.mark.anyio
+async def test_admission_follows_adaptive_limit_growth():
+    admission = scheduler(limit=1)
+    await admission.acquire("normal")
+    order = []
+    tasks = [await enqueue(admission, "normal", order) for _ in range(3)]
+
+    admission.concurrency.limit = 3
+    admission.release(1.0)
+    await asyncio.sleep(0)
+    assert len(order) == 3 and admission.active == 3
+    await asyncio.gather(*tasks)
+
+
+@pytest.mark.anyio
+async def test_generate_answers_429_when_admission_queue_is_full(monkeypatch):
+    release = asyncio.Event()
+    started = asyncio.Event()
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        started.set()
+        await release.wait()
+        return httpx.Response(200, json={"created": 0, "data": [{"url": "https://example.test/image.png"}]})
+
+    monkeypatch.setattr(main, "_upstream_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(main, "generation_scheduler", scheduler(limit=1, max_queue=1))
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+        def generate(index: int):
+            return asyncio.create_task(client.post("/generate", json={
+                "text": f"очередь допуска {index}", "api_key": f"sk-admission-{index}"
+            }))
+
+        active = generate(0)
+        await asyncio.wait_for(started.wait(), 5)
+        queued = generate(1)
+        while main.generation_scheduler.queue_depth == 0:
+            await asyncio.sleep(0.01)
+
+        rejected = await generate(2)
+        assert rejected.status_code == 429
+        assert int(rejected.headers["retry-after"]) >= 1
+        assert rejected.json()["detail"]["retry_after"] == int(rejected.headers["retry-after"])
+
+        release.set()
+        assert [r.json()["mode"] for r in await asyncio.gather(active, queued)] == ["openai", "openai"]
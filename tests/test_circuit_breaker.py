@@ -0,0 +1,106 @@
+import time
+
+import httpx
+import pytest
+
+import main
+
+openai = main.load_openai()
+REQUEST = httpx.Request("POST", "https://api.openai.test/v1/images/generations")
+
+
+def api_error(cls, status: int, code: str, message: str = "error"):
+    response = httpx.Response(status, request=REQUEST)
+    return cls(message, response=response, body={"message": message, "code": code})
+
+
+def test_breaker_opens_then_lets_one_probe_through():
+    breaker = main.CircuitBreaker(failure_threshold=2, reset_timeout=0.05, half_open_probes=1)
+    breaker.record_failure("500", "unknown_error")
+    assert breaker.allow()
+    breaker.record_failure("500", "unknown_error")
+    assert breaker.state == "open" and not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow() and breaker.is_probing()
+    assert not breaker.allow()  # Пробный слот уже занят
+
+    breaker.release_probe()  # Пробный вызов завершился без результата
+    assert breaker.allow()
+    breaker.record_failure("500", "unknown_error")
+    assert breaker.state == "open"
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow()
+
+
+def test_lost_probe_is_reset_after_timeout():
+    breaker = main.CircuitBreaker(failure_threshold=1, reset_timeout=0.05, half_open_probes=1)
+    breaker.record_failure("timeout", "timeout")
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+
+
+def test_guard_caches_auth_error_by_exception_type():
+    guard = main.UpstreamGuard()
+    guard.record("key", api_error(openai.AuthenticationError, 401, "invalid_api_key"))
+
+    with pytest.raises(main.UpstreamShortCircuit) as error:
+        guard.check_cached_error("key")
+    assert error.value.error_type == "auth_error"
+    guard.check_cached_error("other-key")
+
+
+def test_guard_ignores_request_errors():
+    # type invalid_request_error у отказа политики не должен приниматься за неверный ключ
+    guard = main.UpstreamGuard()
+    for _ in range(main.BREAKER_FAILURE_THRESHOLD + 1):
+        guard.record("key", api_error(openai.BadRequestError, 400, "content_policy_violation",
+                                      "invalid_request_error: rejected by safety system"))
+    guard.check_cached_error("key")
+    assert guard.before_call("key") == []
+    assert guard.snapshot()["open_keys"] == {}
+
+
+def test_region_block_applies_to_every_key():
+    guard = main.UpstreamGuard()
+    guard.record("key", api_error(openai.PermissionDeniedError, 403, "unsupported_country_region_territory"))
+    with pytest.raises(main.UpstreamShortCircuit) as error:
+        guard.check_cached_error("another-key")
+    assert error.value.error_type == "region_restriction"
+
+
+def test_guard_opens_key_breaker_and_releases_probe(monkeypatch):
+    monkeypatch.setattr(main, "BREAKER_RESET_TIMEOUT", 0.05)
+    guard = main.UpstreamGuard()
+    for _ in range(main.BREAKER_FAILURE_THRESHOLD):
+        guard.record("key", api_error(openai.InternalServerError, 500, "server_error"))
+
+    with pytest.raises(main.UpstreamShortCircuit) as error:
+        guard.before_call("key")
+    assert error.value.error_type == "unknown_error"
+    assert guard.before_call("healthy-key") == []
+
+    time.sleep(0.06)
+    probes = guard.before_call("key")
+    assert len(probes) == 1
+    with pytest.raises(main.UpstreamShortCircuit):
+        guard.before_call("key")
+    # Вызов не дал результата (например, локальный лимит) - слот возвращается
+    guard.release_probes(probes)
+    probes = guard.before_call("key")
+    guard.record("key", None)
+    guard.release_probes(probes)
+    assert guard.before_call("key") == []
+
+
+def test_timeout_is_classified_by_exception_class():
+    error = openai.APITimeoutError(request=REQUEST)
+    assert str(error) == "Request timed out."
+    assert main.classify_error(error)[0] == "timeout"
+    assert main.classify_error(api_error(openai.RateLimitError, 429, "insufficient_quota"))[0] == "billing_issue"
@@ -0,0 +1,58 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+import main
+
+GENERATIONS = 8
+HEALTH_LATENCY_LIMIT = 0.2
+
+
+@pytest.fixture
+def slow_upstream(monkeypatch):
+    """Фейковый OpenAI: генерация не отвечает, пока тест не отпустит ее"""
+    state = {"started": 0, "all_started": asyncio.Event(), "release": asyncio.Event()}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if not request.url.path.endswith("/images/generations"):
+            return httpx.Response(404)
+        state["started"] += 1
+        if state["started"] == GENERATIONS:
+            state["all_started"].set()
+        await state["release"].wait()
+        prompt = json.loads(request.content)["prompt"]
+        return httpx.Response(200, json={
+            "created": int(time.time()),
+            "data": [{"url": "https://example.test/image.png", "revised_prompt": prompt}]
+        })
+
+    monkeypatch.setattr(main, "_upstream_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return state
+
+
+@pytest.mark.anyio
+async def test_health_is_fast_while_generations_are_in_flight(slow_upstream):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+        generations = [
+            asyncio.create_task(client.post("/generate", json={
+                "text": f"медленная генерация {index}", "api_key": f"sk-concurrency-{index}"
+            }))
+            for index in range(GENERATIONS)
+        ]
+        await asyncio.wait_for(slow_upstream["all_started"].wait(), 5)
+
+        for _ in range(5):
+            started = time.perf_counter()
+            response = await client.get("/health")
+            assert response.status_code == 200
+            assert time.perf_counter() - started < HEALTH_LATENCY_LIMIT
+        assert not any(task.done() for task in generations)
+
+        slow_upstream["release"].set()
+        responses = await asyncio.gather(*generations)
+
+    assert [r.json()["mode"] for r in responses] == ["openai"] * GENERATIONS
@@ -0,0 +1,47 @@
+import os
+import time
+
+import pytest
+
+import main
+
+
+def put_image(store, image_id, mtime, size=100):
+    path = store.original_path(image_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    for target in (path, store.variant_path(image_id, 256, "webp")):
+        with open(target, "wb") as f:
+            f.write(b"x" * size)
+        os.utime(target, (mtime, mtime))
+
+
+def test_prune_removes_least_recently_used_images_with_variants(tmp_path):
+    store = main.ImageStore(str(tmp_path), 1)
+    now = time.time()
+    old, recent, fresh = "a" * 64, "b" * 64, "c" * 64
+    put_image(store, old, now - 300)
+    put_image(store, recent, now - 200)
+    put_image(store, fresh, now - 100)
+
+    # Обращение к старому изображению делает его самым свежим
+    store.touch(old)
+    assert store.prune(400) == 1
+    assert store.has(old) and store.has(fresh)
+    assert not store.has(recent)
+    assert not os.path.exists(store.variant_path(recent, 256, "webp"))
+    assert store.prune(400) == 0
+
+
+@pytest.mark.anyio
+async def test_cache_entry_with_pruned_image_and_expired_link_is_a_miss(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "image_store", main.ImageStore(str(tmp_path), 1))
+    expired_url = "https://example.test/image.png?se=" + time.strftime(
+        "%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() - 60)
+    )
+    cache = main.GenerationCache(16, 3300)
+    await cache.set("key", {"image_url": expired_url, "image_id": "d" * 64})
+    assert await cache.get("key") is None
+
+    put_image(main.image_store, "e" * 64, time.time())
+    await cache.set("kept", {"image_url": expired_url, "image_id": "e" * 64})
+    assert await cache.get("kept") is not None
@@ -0,0 +1,112 @@
+import asyncio
+import time
+
+import pytest
+
+import main
+
+
+class FakeRedis:
+    """Локальная замена redis.asyncio.Redis: get/set(ex, nx)/delete с истечением записей"""
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+
+    def _alive(self, key):
+        if key in self.expires and self.expires[key] <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.data
+
+    async def get(self, key):
+        return self.data[key].encode() if self._alive(key) else None
+
+    async def set(self, key, value, ex=None, nx=False):
+        if nx and self._alive(key):
+            return None
+        self.data[key] = value
+        if ex is not None:
+            self.expires[key] = time.time() + ex
+        return True
+
+    async def delete(self, key):
+        self.data.pop(key, None)
+        self.expires.pop(key, None)
+
+    async def aclose(self):
+        self.data.clear()
+
+
+@pytest.fixture
+def redis_backend():
+    return main.RedisStateBackend(FakeRedis())
+
+
+@pytest.mark.anyio
+async def test_redis_backend_add_is_exclusive(redis_backend):
+    assert await redis_backend.add("flight:k", {"pid": 1}, 10)
+    assert not await redis_backend.add("flight:k", {"pid": 2}, 10)
+    assert await redis_backend.get("flight:k") == {"pid": 1}
+    await redis_backend.delete("flight:k")
+    assert await redis_backend.get("flight:k") is None
+
+
+@pytest.mark.anyio
+async def test_shared_flight_calls_upstream_once_across_workers(redis_backend):
+    calls = 0
+
+    def worker():
+        cache = main.GenerationCache(16, 60, lambda: redis_backend)
+        return cache, main.SharedFlight(cache, lambda: redis_backend, 5, 0.01)
+
+    first_cache, first = worker()
+    _, second = worker()
+
+    async def generate():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        result = {"image_url": "https://example.test/image.png"}
+        await first_cache.set("key", result)
+        return result
+
+    results = await asyncio.gather(first.do("key", generate), second.do("key", generate))
+
+    assert calls == 1
+    assert sorted(shared for _, shared in results) == [False, True]
+    assert results[0][0] == results[1][0]
+
+
+@pytest.mark.anyio
+async def test_shared_entry_from_other_host_falls_back_to_source_url(redis_backend):
+    source_url = "https://example.test/image.png?se=" + time.strftime(
+        "%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 600)
+    )
+    writer = main.GenerationCache(16, 3300, lambda: redis_backend)
+    await writer.set("key", {"image_url": source_url, "image_id": "ab" * 32})
+
+    # Общая запись не переживет ссылку OpenAI, хотя локально файл хранится бессрочно
+    shared = await redis_backend.get("gen:key")
+    assert shared["expires_at"] < time.time() + 600
+
+    reader = main.GenerationCache(16, 3300, lambda: redis_backend)
+    cached = await reader.get("key")
+    request = main.GenerateRequest(text="кот", api_key="sk-test")
+    response = main.openai_response(request, "req", main.datetime.now(), cached, "prompt", "hit")
+    assert response["image_url"] == source_url
+    assert response["image_id"] is None
+
+
+@pytest.mark.anyio
+async def test_running_job_heartbeat_keeps_lease(tmp_path):
+    store = main.JobStore(str(tmp_path / "jobs.db"))
+    try:
+        await store.create("job", main.GenerateRequest(text="кот"))
+        assert await store.claim("job")
+        lease_start = time.time()
+        await store.heartbeat("job")
+        assert await store.requeue_stale(lease_start) == []
+        assert (await store.get("job"))["status"] == "running"
+    finally:
+        store.close()
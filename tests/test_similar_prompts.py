@@ -0,0 +1,22 @@
+import main
+
+
+def test_fingerprint_is_order_independent_and_capped():
+    words = [f"слово{i}" for i in range(500)]
+    forward = main.prompt_fingerprint(" ".join(words))
+    backward = main.prompt_fingerprint(" ".join(reversed(words)))
+    assert forward == backward
+    assert len(forward[0]) == main.SIMILAR_MAX_TOKENS
+    assert main.prompt_fingerprint(" ,.!? ") is None
+
+
+def test_index_reuses_one_fingerprint_for_find_and_add():
+    index = main.SimilarPromptIndex(max_size=10, threshold=0.9)
+    partition = ("realistic", "1024x1024", "standard")
+    fingerprint = main.prompt_fingerprint("рыжий кот спит на старом диване у окна")
+    index.add(fingerprint, partition, "key-1")
+
+    swapped = main.prompt_fingerprint("у окна на старом диване спит рыжий кот")
+    assert [key for _, key in index.find(swapped, partition)] == ["key-1"]
+    assert index.find(swapped, ("anime", "1024x1024", "standard")) == []
+    assert index.find(None, partition) == []
@@ -0,0 +1,12 @@
+import main
+
+
+def test_styles_demo_image_follows_demo_renderer(monkeypatch):
+    monkeypatch.setattr(main, "demo_renderer", main.DemoRenderer(main.DEMO_CACHE_DIR))
+    style = main.build_styles_body(main.datetime.now())["styles"][0]
+    # Тело собирается один раз, поэтому ссылка от корня, а не от адреса запроса
+    assert style["demo_image"].startswith(f"/demo/{style['id']}/1024x1024.webp")
+
+    monkeypatch.setattr(main, "demo_renderer", None)
+    style = main.build_styles_body(main.datetime.now())["styles"][0]
+    assert style["demo_image"] == main.DEMO_IMAGES[style["id"]]
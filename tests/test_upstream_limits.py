@@ -0,0 +1,124 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+
+
+@pytest.fixture
+def hanging_upstream(monkeypatch):
+    """Фейковый OpenAI, который никогда не отвечает на генерацию"""
+    started = asyncio.Event()
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        started.set()
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(main, "_upstream_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return started
+
+
+@pytest.mark.anyio
+async def test_cancelled_call_returns_concurrency_slot(hanging_upstream):
+    limit = main.upstream_concurrency.limit
+    calls = []
+    for index in range(3):
+        hanging_upstream.clear()
+        call = asyncio.create_task(main.call_images_api(f"sk-cancel-{index}", prompt="кот", n=1))
+        await asyncio.wait_for(hanging_upstream.wait(), 5)
+        calls.append(call)
+    assert main.upstream_concurrency.in_flight == 3
+
+    for call in calls:
+        call.cancel()
+    await asyncio.gather(*calls, return_exceptions=True)
+
+    assert main.upstream_concurrency.in_flight == 0
+    # Отмена - не признак перегрузки upstream, лимит не снижается
+    assert main.upstream_concurrency.limit >= limit
+
+
+@pytest.mark.anyio
+async def test_adaptive_limit_blocks_at_limit_and_shrinks_on_overload():
+    limiter = main.AdaptiveConcurrencyLimiter(2, 8, 2, latency_target=10)
+    await limiter.acquire(main.time.monotonic() + 1)
+    await limiter.acquire(main.time.monotonic() + 1)
+    with pytest.raises(main.UpstreamRateLimited):
+        await limiter.acquire(main.time.monotonic() + 0.05)
+
+    await limiter.release(1.0, overloaded=False)
+    assert limiter.limit == pytest.approx(2.5)
+    await limiter.release(1.0, overloaded=True)
+    assert limiter.limit == 2  # 2.5 * 0.7 меньше минимума
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.anyio
+async def test_adaptive_limit_wakes_waiter_on_release():
+    limiter = main.AdaptiveConcurrencyLimiter(1, 1, 1, latency_target=10)
+    await limiter.acquire(main.time.monotonic() + 1)
+    waiter = asyncio.create_task(limiter.acquire(main.time.monotonic() + 5))
+    await asyncio.sleep(0)
+    assert not waiter.done()
+    await limiter.release(20.0, overloaded=False)  # Медленный вызов: лимит не растет
+    await asyncio.wait_for(waiter, 1)
+    assert limiter.in_flight == 1 and limiter.limit == 1
+
+
+def test_token_bucket_reserves_burst_then_asks_to_wait():
+    bucket = main.TokenBucket(rate=1.0, burst=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(1.0, abs=0.01)
+    bucket.refund()
+    assert bucket.reserve() == pytest.approx(1.0, abs=0.01)
+
+
+@pytest.mark.anyio
+async def test_keyed_limiter_learns_limit_from_headers():
+    limiter = main.KeyedRateLimiter(0, 0, max_keys=2)
+    # Лимит ключа неизвестен - вызов не ждет
+    await limiter.acquire("a", main.time.monotonic() + 0.01)
+
+    limiter.observe("a", {"x-ratelimit-limit-requests": "60", "x-ratelimit-remaining-requests": "0"})
+    with pytest.raises(main.UpstreamRateLimited):
+        await limiter.acquire("a", main.time.monotonic() + 0.1)
+    # Неудачное ожидание возвращает токен: следующая попытка ждет не дольше секунды
+    await limiter.acquire("a", main.time.monotonic() + 2)
+
+    limiter.observe("b", {"x-ratelimit-limit-requests": "5"})
+    limiter.observe("c", {"x-ratelimit-limit-requests": "5"})
+    limiter.observe("d", {})
+    assert list(limiter._buckets) == ["b", "c"]
+
+
+@pytest.mark.anyio
+async def test_fixed_limit_ignores_headers():
+    limiter = main.KeyedRateLimiter(60, 1, max_keys=10)
+    limiter.observe("a", {"x-ratelimit-limit-requests": "1", "x-ratelimit-remaining-requests": "0"})
+    await limiter.acquire("a", main.time.monotonic() + 0.01)
+    with pytest.raises(main.UpstreamRateLimited):
+        await limiter.acquire("a", main.time.monotonic() + 0.1)
+
+
+@pytest.mark.anyio
+async def test_rate_limited_call_is_retried_after_retry_after(monkeypatch):
+    attempts = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        attempts.append(main.time.monotonic())
+        if len(attempts) == 1:
+            return httpx.Response(429, headers={"retry-after-ms": "50"}, json={
+                "error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}
+            })
+        return httpx.Response(200, json={"created": 0, "data": [{"url": "https://example.test/image.png"}]})
+
+    monkeypatch.setattr(main, "_upstream_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(main, "OPENAI_BACKOFF_BASE", 0.01)
+    response = await main.call_images_api("sk-retry", prompt="кот", n=1)
+
+    assert response.data[0].url == "https://example.test/image.png"
+    assert len(attempts) == 2
+    assert attempts[1] - attempts[0] >= 0.05
+    assert main.upstream_concurrency.in_flight == 0
@@ -0,0 +1,41 @@
+import json
+
+import httpx
+import pytest
+
+import main
+
+
+def test_text_length_is_checked_after_whitespace_collapse():
+    padded = "кот " + " " * main.TEXT_MAX_LENGTH + "в сапогах"
+    assert main.GenerateRequest(text=padded).text == "кот в сапогах"
+
+    with pytest.raises(main.ValidationError) as error:
+        main.GenerateRequest(text="x" * (main.TEXT_MAX_LENGTH + 1))
+    assert error.value.errors()[0]["type"] == "string_too_long"
+
+
+def test_text_max_length_defaults_to_dalle_limit():
+    assert main.TEXT_MAX_LENGTH == main.DALLE_TEXT_MAX_LENGTH
+    longest_prefix = max(len(prefix) for prefix in main.STYLE_PROMPT_PREFIXES.values())
+    assert main.TEXT_MAX_LENGTH + longest_prefix == main.DALLE_PROMPT_MAX_LENGTH
+
+
+@pytest.mark.anyio
+async def test_invalid_batch_item_does_not_reject_batch():
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.post("/generate/batch", json={"items": [
+            {"text": "лиса в лесу"},
+            {"text": "лиса", "size": "512x512"},
+            "не объект",
+        ]})
+
+    assert response.status_code == 200
+    events = [json.loads(line) for line in response.text.splitlines()]
+    results = {event["index"]: event for event in events if "index" in event}
+    assert results[0]["mode"] == "demo"
+    assert results[1]["status"] == "error"
+    assert results[1]["details"][0]["loc"] == ["size"]
+    assert results[2]["status"] == "error"
+    assert events[-1]["total"] == 3